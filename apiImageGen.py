@@ -1,18 +1,134 @@
+import asyncio
 import base64
+import random
+import time
+from email.utils import parsedate_to_datetime
 import aiohttp
 from aiohttp import FormData
-from PIL import Image
-import io
 import json
-import configparser
 
-# Read the configuration
-config = configparser.ConfigParser()
-config.read('config.properties')
-api_key = config['API']['API_KEY']
-api_host = config['API']['API_HOST']
+from generatedImage import GeneratedImage
+from imagePipeline import run_in_executor
+from metrics import stage
+from resultCache import make_key
+
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=10)
+
+# All set by setup() from the bot's config
+config = None
+api_key = None
+api_host = None
+max_retries = 4
+request_limiter = None
+binary_responses = False
+# Results of deterministic upscales, None when [CACHE] is disabled
+result_cache = None
+# Set when the API asks us to back off, so every request pauses, not just the one that got the 429
+retry_at = 0
+_session = None
+
+def setup(bot_config, cache=None):
+    global config, api_key, api_host, max_retries, request_limiter, binary_responses, result_cache
+    config = bot_config
+    result_cache = cache
+    api_key = config['API']['API_KEY']
+    api_host = config['API']['API_HOST']
+    max_retries = config.getint('API', 'MAX_RETRIES', fallback=4)
+    # Requests in flight are capped to what the account's rate limit allows;
+    # anything beyond that waits here instead of being rejected with a 429
+    request_limiter = asyncio.Semaphore(config.getint('API', 'MAX_CONCURRENT_REQUESTS', fallback=10))
+    # Ask for raw PNGs instead of base64 JSON. The API only returns one image per
+    # binary response, so multi-sample requests are split into parallel single-sample ones.
+    binary_responses = config.getboolean('API', 'BINARY_RESPONSES', fallback=False)
+
+def get_session():
+    # One keep-alive session for the whole bot, so TLS handshakes are reused
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=REQUEST_TIMEOUT)
+    return _session
+
+async def warm_up():
+    # Opens the keep-alive connection and checks the API key before the first job needs them
+    try:
+        async with get_session().get(f"{api_host}/v1/engines/list", headers={"Authorization": f"Bearer {api_key}"}) as response:
+            if response.status != 200:
+                print(f"Stability API rejected the startup check ({response.status}): {await response.text()}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Failed to reach the Stability API at {api_host}: {e!r}")
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+async def post(url, headers, body):
+    # Returns the response body and headers.
+    # body() builds the request body for each attempt, since form data can only be sent once.
+    # 429s and transient 5xx/connection errors are retried with exponential backoff,
+    # honouring Retry-After when the API sends one.
+    global retry_at
+    delay = RETRY_DELAY
+    for attempt in range(max_retries + 1):
+        wait = retry_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        backoff = min(delay, MAX_RETRY_DELAY) * random.uniform(0.8, 1.2)
+        delay *= 2
+        async with request_limiter:
+            try:
+                async with get_session().post(url, headers=headers, **body()) as response:
+                    if response.status == 200:
+                        return await response.read(), response.headers
+                    if response.status != 429 and response.status < 500 or attempt == max_retries:
+                        raise Exception(f"Non-200 response: {await response.text()}")
+                    backoff = retry_after(response) or backoff
+                    if response.status == 429:
+                        retry_at = max(retry_at, time.monotonic() + backoff)
+                    print(f"Stability API returned {response.status}, retrying in {backoff:.1f}s")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == max_retries:
+                    raise
+                print(f"Stability API request failed ({e!r}), retrying in {backoff:.1f}s")
+        await asyncio.sleep(backoff)
+
+def decode_artifacts(body, workflow):
+    # Runs in the image worker pool: parsing and base64-decoding several
+    # megabytes of JSON would otherwise stall the event loop
+    data = json.loads(body)
+    images = []
+    for i, image in enumerate(data["artifacts"]):
+        img_data = base64.b64decode(image["base64"])
+        images.append(GeneratedImage(img_data, metadata={'workflow': workflow, 'seed': image.get('seed')}))
+    return images
 
-async def generate_images(prompt: str,negative_prompt: str,interaction):
+async def fetch_images(url, headers, body, samples, workflow):
+    # body(samples) builds a request body asking for that many images
+    if binary_responses:
+        with stage('execution', 'api'):
+            responses = await asyncio.gather(*(
+                post(url, headers=dict(headers, Accept="image/png"), body=lambda: body(1))
+                for _ in range(samples)))
+        return [GeneratedImage(content, metadata={'workflow': workflow, 'seed': int(response_headers.get('Seed', 0)) or None})
+                for content, response_headers in responses]
+
+    with stage('execution', 'api'):
+        content, _ = await post(url, headers=dict(headers, Accept="application/json"), body=lambda: body(samples))
+    with stage('decode', 'api'):
+        return await run_in_executor(decode_artifacts, content, workflow)
+
+# The Stability API doesn't report progress, so on_progress is accepted and unused
+async def generate_images(prompt: str,negative_prompt: str, on_progress=None):
     if api_key is None:
         raise Exception("Missing Stability API key.")
     
@@ -21,122 +137,111 @@ async def generate_images(prompt: str,negative_prompt: str,interaction):
     if negative_prompt != None:
         text_prompts.append({"text": f"{negative_prompt}","weight": -1.0,})
 
-    async with aiohttp.ClientSession() as session:        
-        async with session.post(
-            f"{api_host}/v1/generation/{config['API_TEXT2IMG']['ENGINE']}/text-to-image",
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            },
-            json={
-                "text_prompts": text_prompts,
-                "cfg_scale": float(config['API_TEXT2IMG']['CFG']),
-                "height": int(config['API_TEXT2IMG']['HEIGHT']),
-                "width": int(config['API_TEXT2IMG']['WIDTH']),
-                "samples": int(config['API_TEXT2IMG']['SAMPLES']),
-                "sampler": str(config['API_TEXT2IMG']['SAMPLER']),
-                "steps": int(config['API_TEXT2IMG']['STEPS'])
-            }
-        ) as response:
-            if response.status != 200:
-                await interaction.followup.send(content="There was an error processing your request, please ensure you dont use any profanity in your prompt")
-                raise Exception(f"Non-200 response: {await response.text()}")
-            data = await response.json()
-
-    images = []
-    for i, image in enumerate(data["artifacts"]):
-        img_data = base64.b64decode(image["base64"])
-        img = Image.open(io.BytesIO(img_data))
-        images.append(img)
+    def payload(samples):
+        return {'json': {
+            "text_prompts": text_prompts,
+            "cfg_scale": float(config['API_TEXT2IMG']['CFG']),
+            "height": int(config['API_TEXT2IMG']['HEIGHT']),
+            "width": int(config['API_TEXT2IMG']['WIDTH']),
+            "samples": samples,
+            "sampler": str(config['API_TEXT2IMG']['SAMPLER']),
+            "steps": int(config['API_TEXT2IMG']['STEPS'])
+        }}
+
+    images = await fetch_images(
+        f"{api_host}/v1/generation/{config['API_TEXT2IMG']['ENGINE']}/text-to-image",
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        },
+        body=payload,
+        samples=int(config['API_TEXT2IMG']['SAMPLES']),
+        workflow='api-text2img'
+    )
 
     return images
 
 
-async def generate_alternatives(image: Image.Image, prompt: str, negative_prompt: str):
+async def generate_alternatives(image: GeneratedImage, prompt: str, negative_prompt: str, on_progress=None):
     if api_key is None:
         raise Exception("Missing Stability API key.")
 
-    # Convert the PIL Image to bytes
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    image_bytes = buffered.getvalue()
+    # The image is still in the PNG encoding the API sent it in
+    image_bytes = image.data
 
     # Create FormData object
-    data = FormData()
-    data.add_field('init_image', image_bytes, filename='init_image.png', content_type='image/png')
-    data.add_field('image_strength', config['API_IMG2IMG']['IMAGE_STRENGTH'])
-    data.add_field('init_image_mode', config['API_IMG2IMG']['INIT_IMAGE_MODE'])
-    data.add_field('cfg_scale', config['API_IMG2IMG']['CFG'])
-    data.add_field('samples', config['API_IMG2IMG']['SAMPLES'])
-    data.add_field('sampler', config['API_IMG2IMG']['SAMPLER'])
-    data.add_field('steps', config['API_IMG2IMG']['STEPS'])
-    data.add_field('text_prompts[0][text]', prompt)
-    data.add_field('text_prompts[0][weight]', str(1.0))
-
-    if negative_prompt != None:
-        data.add_field('text_prompts[1][text]', negative_prompt)
-        data.add_field('text_prompts[1][weight]', str(-1.0))
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{api_host}/v1/generation/{config['API_IMG2IMG']['ENGINE']}/image-to-image",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            },
-            data=data
-        ) as response:
-            if response.status != 200:
-                raise Exception(f"Non-200 response: {await response.text()}")
-            data = await response.json()
+    def form_data(samples):
+        data = FormData()
+        data.add_field('init_image', image_bytes, filename='init_image.png', content_type='image/png')
+        data.add_field('image_strength', config['API_IMG2IMG']['IMAGE_STRENGTH'])
+        data.add_field('init_image_mode', config['API_IMG2IMG']['INIT_IMAGE_MODE'])
+        data.add_field('cfg_scale', config['API_IMG2IMG']['CFG'])
+        data.add_field('samples', str(samples))
+        data.add_field('sampler', config['API_IMG2IMG']['SAMPLER'])
+        data.add_field('steps', config['API_IMG2IMG']['STEPS'])
+        data.add_field('text_prompts[0][text]', prompt)
+        data.add_field('text_prompts[0][weight]', str(1.0))
 
-    alternatives = []
-    for i, image in enumerate(data["artifacts"]):
-        img_data = base64.b64decode(image["base64"])
-        img = Image.open(io.BytesIO(img_data))
-        alternatives.append(img)
+        if negative_prompt != None:
+            data.add_field('text_prompts[1][text]', negative_prompt)
+            data.add_field('text_prompts[1][weight]', str(-1.0))
+        return {'data': data}
+
+    alternatives = await fetch_images(
+        f"{api_host}/v1/generation/{config['API_IMG2IMG']['ENGINE']}/image-to-image",
+        headers={
+            "Authorization": f"Bearer {api_key}"
+        },
+        body=form_data,
+        samples=int(config['API_IMG2IMG']['SAMPLES']),
+        workflow='api-img2img'
+    )
 
     return alternatives
 
-async def upscale_image(image: Image.Image, prompt: str,negative_prompt: str):
+async def upscale_image(image: GeneratedImage, prompt: str,negative_prompt: str, on_progress=None):
     if api_key is None:
         raise Exception("Missing Stability API key.")
 
-    # Convert the PIL Image to bytes
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    image_bytes = buffered.getvalue()
+    # The image is still in the PNG encoding the API sent it in
+    image_bytes = image.data
 
     # Create FormData object
-    data = FormData()
-    data.add_field('image', image_bytes, filename='init_image.png', content_type='image/png')
-    data.add_field('width', config['API_UPSCALE']['WIDTH'])
-
-    if config['API_UPSCALE']['ENGINE']!='esrgan-v1-x2plus':
-        data.add_field('seed',config['API_UPSCALE']['SEED'])
-        data.add_field('steps',config['API_UPSCALE']['STEPS'])
-        data.add_field('cfg_scale',config['API_UPSCALE']['CFG'])
-        data.add_field('text_prompts[0][text]', prompt)
-        data.add_field('text_prompts[0][weight]', str(1.0))
-        if negative_prompt != None:
-            data.add_field('text_prompts[1][text]', negative_prompt)
-            data.add_field('text_prompts[1][weight]', str(-1.0))
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{api_host}/v1/generation/{config['API_IMG2IMG']['ENGINE']}/image-to-image/upscale",
-            headers={
-                "Accept": "image/png",
-                "Authorization": f"Bearer {api_key}"
-            },
-            data=data
-        ) as response:
-            if response.status != 200:
-                raise Exception(f"Non-200 response: {await response.text()}")
-            upscaled_image_bytes = await response.read()
-
-    # Convert the bytes to a PIL Image
-    upscaled_image = Image.open(io.BytesIO(upscaled_image_bytes))
-
-    return upscaled_image
\ No newline at end of file
+    def form_data():
+        data = FormData()
+        data.add_field('image', image_bytes, filename='init_image.png', content_type='image/png')
+        data.add_field('width', config['API_UPSCALE']['WIDTH'])
+
+        if config['API_UPSCALE']['ENGINE']!='esrgan-v1-x2plus':
+            data.add_field('seed',config['API_UPSCALE']['SEED'])
+            data.add_field('steps',config['API_UPSCALE']['STEPS'])
+            data.add_field('cfg_scale',config['API_UPSCALE']['CFG'])
+            data.add_field('text_prompts[0][text]', prompt)
+            data.add_field('text_prompts[0][weight]', str(1.0))
+            if negative_prompt != None:
+                data.add_field('text_prompts[1][text]', negative_prompt)
+                data.add_field('text_prompts[1][weight]', str(-1.0))
+        return {'data': data}
+
+    url = f"{api_host}/v1/generation/{config['API_IMG2IMG']['ENGINE']}/image-to-image/upscale"
+
+    async def render():
+        with stage('execution', 'api'):
+            upscaled_image_bytes, _ = await post(
+                url,
+                headers={
+                    "Accept": "image/png",
+                    "Authorization": f"Bearer {api_key}"
+                },
+                body=form_data
+            )
+        return [GeneratedImage(upscaled_image_bytes, metadata={'workflow': 'api-upscale'})]
+
+    # ESRGAN has no randomness, and the diffusion upscaler is repeatable once given a fixed seed
+    esrgan = config['API_UPSCALE']['ENGINE'] == 'esrgan-v1-x2plus'
+    if result_cache is None or not (esrgan or int(config['API_UPSCALE']['SEED'])):
+        return (await render())[0]
+    fields = ['WIDTH'] if esrgan else ['WIDTH', 'SEED', 'STEPS', 'CFG']
+    key = make_key(url, [config['API_UPSCALE'][field] for field in fields],
+                   None if esrgan else [prompt, negative_prompt], image.sha256)
+    return (await result_cache.run(key, render))[0]
\ No newline at end of file
@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from fakeComfyUI import FakeComfyUI
+from fakeDiscord import FakeChannel, FakeGuild, FakeInteraction, FakeUser
+from fakeStability import FakeStability
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKFLOW_DIR = os.path.join(REPO_DIR, 'comfyUI-workflows')
+
+DEFAULT_PROMPTS = [
+    "a lighthouse on a cliff at sunset, oil painting",
+    "a cyberpunk street market in the rain, neon lights",
+    "portrait of an old fisherman, dramatic lighting",
+    "a cozy cabin in a snowy forest, isometric",
+    "an astronaut riding a horse on mars, photorealistic",
+    "a bowl of ramen, studio photography",
+    "a dragon made of autumn leaves",
+    "a watercolor map of a fantasy kingdom",
+]
+
+# The Buttons a simulated user may click on a finished collage
+BUTTONS = ('V1', 'U1', 'Re-roll')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def load_prompts(path):
+    if path is None:
+        return DEFAULT_PROMPTS
+    prompts = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                entry = json.loads(line)
+                line = entry.get('prompt') or entry.get('title')
+            if line:
+                prompts.append(line)
+    return prompts
+
+
+def write_config(args, comfy_ports, stability_port):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['BOT'] = {'TOKEN': 'benchmark', 'SDXL_SOURCE': args.source}
+    config['LOCAL'] = {'SERVER_ADDRESS': ','.join(f'127.0.0.1:{port}' for port in comfy_ports)}
+    config['LOCAL_TEXT2IMG'] = {
+        'CONFIG': os.path.join(WORKFLOW_DIR, 'text2img_config.json'),
+        'PROMPT_NODES': '6,12', 'NEG_PROMPT_NODES': '7,13', 'RAND_SEED_NODES': '17,20',
+        'BATCH_SIZE_NODES': '21', 'BATCH_WINDOW_MS': str(args.batch_window_ms),
+    }
+    config['LOCAL_IMG2IMG'] = {
+        'CONFIG': os.path.join(WORKFLOW_DIR, 'img2img_config.json'),
+        'PROMPT_NODES': '2', 'NEG_PROMPT_NODES': '3', 'RAND_SEED_NODES': '4', 'FILE_INPUT_NODES': '5',
+    }
+    config['LOCAL_UPSCALE'] = {
+        'CONFIG': os.path.join(WORKFLOW_DIR, 'upscale_config.json'),
+        'PROMPT_NODES': '', 'NEG_PROMPT_NODES': '', 'RAND_SEED_NODES': '', 'FILE_INPUT_NODES': '1',
+    }
+    config['API'] = {'API_KEY': 'benchmark', 'API_HOST': f'http://127.0.0.1:{stability_port}',
+                     'API_IMAGE_ENGINE': 'stable-diffusion-xl-1024-v1-0'}
+    config['API_TEXT2IMG'] = {'ENGINE': 'stable-diffusion-xl-1024-v1-0', 'CFG': '7', 'HEIGHT': '1024', 'WIDTH': '1024',
+                              'SAMPLES': '4', 'SAMPLER': 'K_DPMPP_2S_ANCESTRAL', 'STEPS': '30'}
+    config['API_IMG2IMG'] = {'ENGINE': 'stable-diffusion-xl-1024-v1-0', 'CFG': '7', 'SAMPLES': '4', 'SAMPLER': 'K_DPMPP_2S_ANCESTRAL',
+                             'STEPS': '30', 'IMAGE_STRENGTH': '0.35', 'INIT_IMAGE_MODE': 'IMAGE_STRENGTH'}
+    config['API_UPSCALE'] = {'ENGINE': 'esrgan-v1-x2plus', 'WIDTH': '2048', 'SEED': '0', 'STEPS': '30', 'CFG': '7'}
+    config['SCHEDULER'] = {'MAX_CONCURRENT': str(args.max_concurrent), 'MAX_QUEUE': str(args.max_queue),
+                           'MAX_QUEUED_PER_USER': str(args.max_queue)}
+    config['OUTPUT'] = {'SAVE_TO_DISK': str(args.save_outputs), 'DIRECTORY': './out'}
+    config['VIEWS'] = {'DIRECTORY': './views', 'CACHE_MB': str(args.view_cache_mb)}
+    with open('config.properties', 'w') as configfile:
+        config.write(configfile)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoopLagMonitor:
+    # Samples how late the event loop wakes a sleeping task; anything beyond
+    # a few milliseconds is time the loop spent blocked
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - start - self.interval)
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.outcomes = {}
+
+    def record(self, kind, seconds, outcome):
+        self.outcomes[(kind, outcome)] = self.outcomes.get((kind, outcome), 0) + 1
+        if outcome == 'ok':
+            self.latencies.setdefault(kind, []).append(seconds)
+
+
+async def timed(results, kind, handler, interaction, *args):
+    start = time.perf_counter()
+    sent_before = len(interaction.channel.sent)
+    try:
+        await handler(interaction, *args)
+    except Exception as e:
+        results.record(kind, time.perf_counter() - start, type(e).__name__)
+        return None
+    if len(interaction.channel.sent) == sent_before:
+        # The handler answered with an ephemeral message, i.e. the queue turned it away
+        results.record(kind, time.perf_counter() - start, 'rejected')
+        return None
+    results.record(kind, time.perf_counter() - start, 'ok')
+    return interaction.channel.sent[-1]
+
+
+async def simulate_user(bot, user_id, jobs, prompts, args, results, rng):
+    # One user: /imagine, then maybe a click on the result, until the shared job budget is used up
+    user = FakeUser(user_id)
+    guild = FakeGuild()
+    channel = FakeChannel(args.discord_latency)
+    while jobs:
+        jobs.pop()
+        prompt = rng.choice(prompts)
+        interaction = FakeInteraction(user, channel, guild)
+        message = await timed(results, 'imagine', bot.slash_command.callback, interaction, prompt, None)
+
+        while message is not None and message.view is not None and jobs and rng.random() < args.click_rate:
+            jobs.pop()
+            label = rng.choice(BUTTONS)
+            button = next(item for item in message.view.children if getattr(item, 'label', None) == label)
+            interaction = FakeInteraction(user, channel, guild, message, custom_id=button.custom_id)
+            result = await timed(results, label, bot.on_interaction, interaction)
+            # Only variations and re-rolls come back with more buttons to click
+            message = result if label != 'U1' else None
+
+        if args.think_time:
+            await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+
+async def run(bot, args):
+    comfy_servers = []
+    stability = None
+    if args.source == 'LOCAL':
+        for port in args.comfy_ports:
+            server = FakeComfyUI(latency=args.comfy_latency, workers=args.comfy_workers, image_size=args.image_size)
+            await server.start(port=port)
+            comfy_servers.append(server)
+    else:
+        stability = FakeStability(latency=args.api_latency, image_size=args.image_size, rate_limit=args.api_rate_limit)
+        await stability.start(port=args.stability_port)
+
+    results = Results()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    if args.tracemalloc:
+        tracemalloc.start()
+    # What the bot's setup_hook starts while it connects to Discord
+    await bot.warm_up()
+    rng = random.Random(args.seed)
+    jobs = list(range(args.jobs))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate_user(bot, user_id, jobs, args.prompts, args, results, random.Random(rng.random()))
+                           for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - start
+
+    monitor.stop()
+    report = {
+        'source': args.source,
+        'users': args.users,
+        'elapsed_seconds': round(elapsed, 3),
+        'jobs_per_second': round(sum(len(values) for values in results.latencies.values()) / elapsed, 3),
+        'latency_seconds': {kind: {'count': len(values),
+                                   'p50': round(percentile(values, 0.50), 3),
+                                   'p95': round(percentile(values, 0.95), 3),
+                                   'p99': round(percentile(values, 0.99), 3)}
+                            for kind, values in results.latencies.items()},
+        'outcomes': {f'{kind}/{outcome}': count for (kind, outcome), count in sorted(results.outcomes.items())},
+        'loop_lag_ms': {'p50': round(percentile(monitor.samples, 0.50) * 1000, 2),
+                        'p99': round(percentile(monitor.samples, 0.99) * 1000, 2),
+                        'max': round(max(monitor.samples, default=0) * 1000, 2)},
+        'stage_mean_seconds': stage_means(),
+        'backend_stats': [server.stats for server in comfy_servers] if comfy_servers else stability.stats,
+    }
+    if args.tracemalloc:
+        report['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS; includes the fake servers
+        scale = 1 if sys.platform == 'darwin' else 1024
+        report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20, 1)
+
+    await shutdown(args)
+    for server in comfy_servers:
+        await server.stop()
+    if stability is not None:
+        await stability.stop()
+    return report
+
+
+def stage_means():
+    from metrics import STAGE_SECONDS
+    return {f'{stage}/{source}': round(counts[-1] / counts[-2], 4)
+            for (stage, source), counts in sorted(STAGE_SECONDS._values.items()) if counts[-2]}
+
+
+async def shutdown(args):
+    if args.source == 'LOCAL':
+        import comfyHttp
+        import imageGen
+        for backend in imageGen.backends.backends:
+            await backend.connection.close()
+        await comfyHttp.close_session()
+    else:
+        import apiImageGen
+        await apiImageGen.get_session().close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a workload against the bot's handlers using local fakes of ComfyUI, the Stability API and Discord.")
+    parser.add_argument('--source', choices=('LOCAL', 'API'), default='LOCAL')
+    parser.add_argument('--jobs', type=int, default=40, help='total number of commands and button clicks to run')
+    parser.add_argument('--users', type=int, default=8, help='simulated users running commands at the same time')
+    parser.add_argument('--click-rate', type=float, default=0.5, help='chance of clicking a button on each result')
+    parser.add_argument('--think-time', type=float, default=0, help='mean pause in seconds between a user\'s commands')
+    parser.add_argument('--prompts', help='file of prompts, one per line, or a .jsonl file with "prompt" or "title" fields')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backends', type=int, default=1, help='number of fake ComfyUI servers')
+    parser.add_argument('--comfy-latency', type=float, default=1.0, help='seconds per sampler node')
+    parser.add_argument('--comfy-workers', type=int, default=1, help='prompts each fake ComfyUI runs at once')
+    parser.add_argument('--api-latency', type=float, default=2.0, help='seconds per Stability API request')
+    parser.add_argument('--api-rate-limit', type=int, help='concurrent Stability requests before 429s')
+    parser.add_argument('--discord-latency', type=float, default=0.1, help='seconds per Discord API call')
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--max-concurrent', type=int, default=2, help='[SCHEDULER] MAX_CONCURRENT')
+    parser.add_argument('--max-queue', type=int, default=1000, help='[SCHEDULER] MAX_QUEUE and MAX_QUEUED_PER_USER')
+    parser.add_argument('--batch-window-ms', type=float, default=0, help='[LOCAL_TEXT2IMG] BATCH_WINDOW_MS')
+    parser.add_argument('--view-cache-mb', type=float, default=256, help='[VIEWS] CACHE_MB')
+    parser.add_argument('--save-outputs', action='store_true', help='write outputs to the temporary directory')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report the peak Python heap (slows the run down)')
+    parser.add_argument('--output', help='write the JSON report here as well')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.prompts = load_prompts(args.prompts)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    args.comfy_ports = [free_port() for _ in range(args.backends)]
+    args.stability_port = free_port()
+
+    # The bot reads config.properties from the working directory on import
+    workdir = tempfile.mkdtemp(prefix='sdxl-bot-benchmark-')
+    os.chdir(workdir)
+    write_config(args, args.comfy_ports, args.stability_port)
+    sys.path.insert(0, REPO_DIR)
+    import bot
+
+    report = asyncio.run(run(bot, args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
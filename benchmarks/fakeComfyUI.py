@@ -0,0 +1,174 @@
+import asyncio
+import json
+import uuid
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+# ComfyUI's binary websocket event for latent previews, followed by a 4 byte image format
+PREVIEW_FRAME = (1).to_bytes(4, 'big') + (2).to_bytes(4, 'big')
+
+
+def noise_png(width, height):
+    # Noise compresses about as badly as a real render, so transfer and
+    # encode costs are realistic
+    buffered = BytesIO()
+    Image.effect_noise((width, height), 64).convert('RGB').save(buffered, format='PNG')
+    return buffered.getvalue()
+
+
+class FakeComfyUI:
+    # Stands in for a ComfyUI server: prompts are queued and "executed" by
+    # `workers` simulated GPUs, each sampler node taking `latency` seconds,
+    # with the same websocket events, history entries and files as the real thing
+    def __init__(self, latency=2.0, workers=1, image_size=1024, preview_size=128, steps=10):
+        self.latency = latency
+        self.workers = workers
+        self.steps = steps
+        self.image = noise_png(image_size, image_size)
+        self.preview = PREVIEW_FRAME + noise_png(preview_size, preview_size)
+        self.pending = asyncio.Queue()
+        self.running = {}
+        self.history = {}
+        self.files = {}
+        self.sockets = {}
+        self.stats = {'prompts': 0, 'views': 0, 'uploads': 0, 'interrupts': 0, 'deleted': 0}
+        self._cancelled = set()
+        self._tasks = []
+
+    async def start(self, host='127.0.0.1', port=8188):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post('/prompt', self.handle_prompt)
+        app.router.add_get('/history/{prompt_id}', self.handle_history)
+        app.router.add_get('/view', self.handle_view)
+        app.router.add_post('/upload/image', self.handle_upload)
+        app.router.add_get('/queue', self.handle_get_queue)
+        app.router.add_post('/queue', self.handle_post_queue)
+        app.router.add_post('/interrupt', self.handle_interrupt)
+        app.router.add_get('/system_stats', self.handle_system_stats)
+        app.router.add_get('/ws', self.handle_websocket)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await self.runner.cleanup()
+
+    async def send(self, client_id, message):
+        socket = self.sockets.get(client_id)
+        if socket is None or socket.closed:
+            return
+        if isinstance(message, bytes):
+            await socket.send_bytes(message)
+        else:
+            await socket.send_str(json.dumps(message))
+
+    async def handle_prompt(self, request):
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.stats['prompts'] += 1
+        self.pending.put_nowait((prompt_id, body['prompt'], body.get('client_id')))
+        return web.json_response({'prompt_id': prompt_id, 'number': self.stats['prompts'], 'node_errors': {}})
+
+    async def _worker(self):
+        while True:
+            prompt_id, prompt, client_id = await self.pending.get()
+            if prompt_id in self._cancelled:
+                continue
+            # Executed as its own task so /interrupt can stop it without stopping the worker
+            execution = self.running[prompt_id] = asyncio.create_task(self._execute(prompt_id, prompt, client_id))
+            try:
+                await execution
+            except asyncio.CancelledError:
+                if prompt_id not in self._cancelled:
+                    raise
+                self.history[prompt_id] = {'prompt': [0, prompt_id, prompt, {}, []], 'outputs': {},
+                                           'status': {'status_str': 'error', 'completed': False}}
+                await self.send(client_id, {'type': 'execution_interrupted', 'data': {'prompt_id': prompt_id}})
+                await self.send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+            finally:
+                self.running.pop(prompt_id, None)
+
+    async def _execute(self, prompt_id, prompt, client_id):
+        await self.send(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id}})
+        batch_size = 1
+        for node in prompt.values():
+            if node['class_type'] == 'EmptyLatentImage':
+                batch_size = max(batch_size, node['inputs'].get('batch_size', 1))
+
+        outputs = {}
+        for node_id, node in prompt.items():
+            await self.send(client_id, {'type': 'executing', 'data': {'node': node_id, 'prompt_id': prompt_id}})
+            if node['class_type'] == 'KSampler':
+                for step in range(self.steps):
+                    await asyncio.sleep(self.latency / self.steps)
+                    await self.send(client_id, {'type': 'progress', 'data': {'value': step + 1, 'max': self.steps, 'prompt_id': prompt_id, 'node': node_id}})
+                    await self.send(client_id, self.preview)
+            elif node['class_type'] == 'SaveImage':
+                images = []
+                for idx in range(batch_size):
+                    filename = f"{node['inputs']['filename_prefix']}_{prompt_id[:8]}_{idx:05}_.png"
+                    self.files[('output', '', filename)] = self.image
+                    images.append({'filename': filename, 'subfolder': '', 'type': 'output'})
+                outputs[node_id] = {'images': images}
+
+        self.history[prompt_id] = {'prompt': [0, prompt_id, prompt, {}, []], 'outputs': outputs,
+                                   'status': {'status_str': 'success', 'completed': True}}
+        await self.send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+
+    async def handle_history(self, request):
+        prompt_id = request.match_info['prompt_id']
+        if prompt_id not in self.history:
+            return web.json_response({})
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def handle_view(self, request):
+        self.stats['views'] += 1
+        data = self.files.get((request.query.get('type', 'output'), request.query.get('subfolder', ''), request.query['filename']))
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type='image/png')
+
+    async def handle_upload(self, request):
+        self.stats['uploads'] += 1
+        form = await request.post()
+        image = form['image']
+        subfolder = form.get('subfolder', '')
+        self.files[(form.get('type', 'input'), subfolder, image.filename)] = image.file.read()
+        return web.json_response({'name': image.filename, 'subfolder': subfolder, 'type': form.get('type', 'input')})
+
+    async def handle_get_queue(self, request):
+        running = [[0, prompt_id] for prompt_id in self.running]
+        pending = [[0, prompt_id] for prompt_id, _, _ in list(self.pending._queue) if prompt_id not in self._cancelled]
+        return web.json_response({'queue_running': running, 'queue_pending': pending})
+
+    async def handle_post_queue(self, request):
+        body = await request.json()
+        for prompt_id in body.get('delete', []):
+            self._cancelled.add(prompt_id)
+            self.stats['deleted'] += 1
+        return web.json_response({})
+
+    async def handle_interrupt(self, request):
+        self.stats['interrupts'] += 1
+        for prompt_id, task in list(self.running.items()):
+            self._cancelled.add(prompt_id)
+            task.cancel()
+        return web.json_response({})
+
+    async def handle_system_stats(self, request):
+        return web.json_response({'system': {}, 'devices': [{'name': 'fake', 'vram_total': 24 * 2 ** 30, 'vram_free': 16 * 2 ** 30}]})
+
+    async def handle_websocket(self, request):
+        socket = web.WebSocketResponse(max_msg_size=0)
+        await socket.prepare(request)
+        client_id = request.query.get('clientId')
+        self.sockets[client_id] = socket
+        await socket.send_str(json.dumps({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': self.pending.qsize()}}, 'sid': client_id}}))
+        async for _ in socket:
+            pass
+        return socket
@@ -0,0 +1,101 @@
+import asyncio
+import itertools
+import time
+
+import discord
+
+# Same limit as a guild without boosts
+FILESIZE_LIMIT = 25 * 1024 * 1024
+
+_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    def __init__(self, filesize_limit=FILESIZE_LIMIT):
+        self.id = next(_ids)
+        self.filesize_limit = filesize_limit
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, file=None, view=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.file = file
+        self.view = view
+        self.created = time.perf_counter()
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+class FakeChannel:
+    # Every call to Discord takes `latency` seconds, as a REST round trip would
+    def __init__(self, latency=0.1):
+        self.id = next(_ids)
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, content=None, file=None, view=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        if file is not None:
+            # Reading the attachment is what discord.py does when uploading it
+            file.fp.read()
+        message = FakeMessage(self, content, file, view)
+        self.sent.append(message)
+        return message
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, ephemeral=False, view=None, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._done = True
+        self.interaction.original_response = FakeMessage(self.interaction.channel, content, view=view)
+        self.interaction.ephemeral = ephemeral
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(self.interaction.channel.latency)
+        self._done = True
+
+
+class FakeInteraction:
+    # The parts of discord.Interaction the bot's handlers use. Pass a
+    # custom_id to make it a button click on `message`.
+    def __init__(self, user, channel, guild=None, message=None, custom_id=None):
+        self.id = next(_ids)
+        if custom_id is None:
+            self.type = discord.InteractionType.application_command
+            self.data = {}
+        else:
+            self.type = discord.InteractionType.component
+            self.data = {'custom_id': custom_id, 'component_type': 2}
+        self.user = user
+        self.channel = channel
+        self.guild = guild
+        self.message = message
+        self.response = FakeResponse(self)
+        self.original_response = None
+        self.ephemeral = False
+        self.edits = 0
+
+    async def edit_original_response(self, content=None, attachments=None, view=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.edits += 1
+        if self.original_response is not None and content is not None:
+            self.original_response.content = content
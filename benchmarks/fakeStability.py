@@ -0,0 +1,61 @@
+import asyncio
+import base64
+import random
+
+from aiohttp import web
+
+from fakeComfyUI import noise_png
+
+
+class FakeStability:
+    # Stands in for the Stability v1 generation API. Every request takes
+    # `latency` seconds; when more than `rate_limit` are in flight the extra
+    # ones get a 429 with Retry-After, like the real API under load.
+    def __init__(self, latency=5.0, image_size=1024, rate_limit=None, retry_after=1):
+        self.latency = latency
+        self.image = noise_png(image_size, image_size)
+        self.encoded_image = base64.b64encode(self.image).decode()
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'max_in_flight': 0}
+
+    async def start(self, host='127.0.0.1', port=8189):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_get('/v1/engines/list', self.handle_engines)
+        app.router.add_post('/v1/generation/{engine}/text-to-image', self.handle_generation)
+        app.router.add_post('/v1/generation/{engine}/image-to-image', self.handle_generation)
+        app.router.add_post('/v1/generation/{engine}/image-to-image/upscale', self.handle_generation)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle_engines(self, request):
+        return web.json_response([{'id': 'stable-diffusion-xl-1024-v1-0', 'type': 'PICTURE'}])
+
+    async def handle_generation(self, request):
+        self.stats['requests'] += 1
+        if self.rate_limit is not None and self.in_flight >= self.rate_limit:
+            self.stats['rate_limited'] += 1
+            return web.Response(status=429, headers={'Retry-After': str(self.retry_after)}, text='Too many requests')
+
+        self.in_flight += 1
+        self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+        try:
+            if request.content_type == 'application/json':
+                samples = int((await request.json()).get('samples', 1))
+            else:
+                samples = int((await request.post()).get('samples', 1))
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+        if request.headers.get('Accept') == 'image/png':
+            return web.Response(body=self.image, content_type='image/png',
+                                headers={'Seed': str(random.randint(0, 2 ** 32 - 1)), 'Finish-Reason': 'SUCCESS'})
+        return web.json_response({'artifacts': [
+            {'base64': self.encoded_image, 'seed': random.randint(0, 2 ** 32 - 1), 'finishReason': 'SUCCESS'}
+            for _ in range(samples)]})
@@ -2,154 +2,521 @@ import discord
 import discord.ext
 from discord import app_commands
 import configparser
+import asyncio
+import hashlib
+import inspect
+import json
 import os
-from PIL import Image
-from datetime import datetime
-from math import ceil, sqrt
+import sys
+from io import BytesIO
+
+from imagePipeline import DISCORD_UPLOAD_LIMIT, render_collage, render_image, setup_executor
+from outputStore import OutputStore
+from viewStore import ViewStore
+from progressReporter import ProgressReporter
+from jobScheduler import JobScheduler, JobCancelledError, QueueFullError, PRIORITY_TEXT2IMG, PRIORITY_VARIATION, PRIORITY_UPSCALE
+from metrics import FAILURES, enable_json_logs, stage, start_server, track_job
+from resultCache import ResultCache
+from comfyBackends import BackendUnavailableError, PromptFailedError
+
+DEFAULT_TOKEN = 'YOUR_DEFAULT_DISCORD_BOT_TOKEN'
+DEFAULT_SERVER_ADDRESS = 'YOUR_COMFYUI_URL'
+
+# Settings each image source reads without a fallback
+REQUIRED_SETTINGS = {
+    'LOCAL': {
+        'LOCAL': ['SERVER_ADDRESS'],
+        'LOCAL_TEXT2IMG': ['CONFIG'],
+        'LOCAL_IMG2IMG': ['CONFIG'],
+        'LOCAL_UPSCALE': ['CONFIG'],
+    },
+    'API': {
+        'API': ['API_KEY', 'API_HOST'],
+        'API_TEXT2IMG': ['ENGINE', 'CFG', 'HEIGHT', 'WIDTH', 'SAMPLES', 'SAMPLER', 'STEPS'],
+        'API_IMG2IMG': ['ENGINE', 'IMAGE_STRENGTH', 'INIT_IMAGE_MODE', 'CFG', 'SAMPLES', 'SAMPLER', 'STEPS'],
+        'API_UPSCALE': ['ENGINE', 'WIDTH'],
+    },
+}
+
+def check_config(config):
+    # Returns everything that is wrong with the config, so it can all be
+    # reported before starting instead of surfacing one KeyError at a time
+    problems = []
+    token = config.get('BOT', 'TOKEN', fallback='')
+    if not token or token == DEFAULT_TOKEN:
+        problems.append("[BOT] TOKEN is not set")
+    source = config.get('BOT', 'SDXL_SOURCE', fallback='')
+    if source not in REQUIRED_SETTINGS:
+        problems.append(f"[BOT] SDXL_SOURCE must be LOCAL or API, not '{source}'")
+        return problems
+
+    required = dict(REQUIRED_SETTINGS[source])
+    if source == 'API' and config.get('API_UPSCALE', 'ENGINE', fallback='esrgan-v1-x2plus') != 'esrgan-v1-x2plus':
+        # Only the diffusion upscaler takes these
+        required['API_UPSCALE'] = required['API_UPSCALE'] + ['SEED', 'STEPS', 'CFG']
+    for section, keys in required.items():
+        if not config.has_section(section):
+            problems.append(f"[{section}] is missing")
+            continue
+        problems.extend(f"[{section}] {key} is missing" for key in keys if not config.has_option(section, key))
+
+    if source == 'LOCAL':
+        if config.get('LOCAL', 'SERVER_ADDRESS', fallback='') == DEFAULT_SERVER_ADDRESS:
+            problems.append("[LOCAL] SERVER_ADDRESS is not set")
+        for section in ('LOCAL_TEXT2IMG', 'LOCAL_IMG2IMG', 'LOCAL_UPSCALE'):
+            path = config.get(section, 'CONFIG', fallback=None)
+            if path and not os.path.isfile(path):
+                problems.append(f"[{section}] CONFIG: workflow file {path} does not exist")
+    return problems
 
 def setup_config():
     if not os.path.exists('config.properties'):
         generate_default_config()
 
-    if not os.path.exists('./out'):
-        os.makedirs('./out')
-
     config = configparser.ConfigParser()
     config.read('config.properties')
-    return config['BOT']['TOKEN'], config['BOT']['SDXL_SOURCE']
+    problems = check_config(config)
+    if problems:
+        print("Please fix config.properties before starting the bot:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+    return config
+
+def setup_scheduler(config):
+    # Discord stops accepting edits to the status message after 15 minutes
+    job_timeout = config.getfloat('SCHEDULER', 'JOB_TIMEOUT', fallback=600)
+    return JobScheduler(
+        max_concurrent=config.getint('SCHEDULER', 'MAX_CONCURRENT', fallback=1),
+        max_queue=config.getint('SCHEDULER', 'MAX_QUEUE', fallback=20),
+        max_queued_per_user=config.getint('SCHEDULER', 'MAX_QUEUED_PER_USER', fallback=3),
+        job_timeout=job_timeout if job_timeout > 0 else None,
+    )
+
+def setup_image_pipeline(config):
+    setup_executor(config.getint('OUTPUT', 'WORKERS', fallback=min(4, os.cpu_count() or 1)))
+
+def storage_budget(config, section, max_size_mb, max_age_days):
+    # MAX_SIZE_MB and MAX_AGE_DAYS as bytes and seconds; 0 turns a limit off
+    max_size_mb = config.getfloat(section, 'MAX_SIZE_MB', fallback=max_size_mb)
+    max_age_days = config.getfloat(section, 'MAX_AGE_DAYS', fallback=max_age_days)
+    return (int(max_size_mb * 1024 * 1024) if max_size_mb > 0 else None,
+            max_age_days * 86400 if max_age_days > 0 else None)
+
+def setup_output_store(config):
+    if not config.getboolean('OUTPUT', 'SAVE_TO_DISK', fallback=True):
+        return None
+    max_bytes, max_age = storage_budget(config, 'OUTPUT', 1024, 30)
+    return OutputStore(config.get('OUTPUT', 'DIRECTORY', fallback='./out'), max_bytes=max_bytes, max_age=max_age)
+
+def setup_progress_reporter(config):
+    return ProgressReporter(
+        edits_per_second=config.getfloat('PROGRESS', 'EDITS_PER_SECOND', fallback=4),
+        min_interval=config.getfloat('PROGRESS', 'MIN_EDIT_INTERVAL', fallback=2),
+        previews=config.getboolean('PROGRESS', 'PREVIEWS', fallback=True),
+    )
+
+async def setup_metrics(config):
+    port = config.getint('METRICS', 'PORT', fallback=0)
+    if port:
+        await start_server(config.get('METRICS', 'HOST', fallback='127.0.0.1'), port)
+
+def setup_view_store(config):
+    max_bytes, max_age = storage_budget(config, 'VIEWS', 2048, 30)
+    return ViewStore(
+        config.get('VIEWS', 'DIRECTORY', fallback='./views'),
+        cache_bytes=int(config.getfloat('VIEWS', 'CACHE_MB', fallback=256) * 1024 * 1024),
+        max_bytes=max_bytes,
+        max_age=max_age,
+    )
+
+def setup_result_cache(config):
+    if not config.getboolean('CACHE', 'ENABLED', fallback=True):
+        return None
+    max_bytes, max_age = storage_budget(config, 'CACHE', 2048, 7)
+    return ResultCache(
+        config.get('CACHE', 'DIRECTORY', fallback='./cache'),
+        memory_bytes=int(config.getfloat('CACHE', 'MEMORY_MB', fallback=256) * 1024 * 1024),
+        max_bytes=max_bytes,
+        max_age=max_age,
+    )
 
 def generate_default_config():
     config = configparser.ConfigParser()
-    config['DISCORD'] = {
-        'TOKEN': 'YOUR_DEFAULT_DISCORD_BOT_TOKEN'
+    config['BOT'] = {
+        'TOKEN': DEFAULT_TOKEN,
+        'SDXL_SOURCE': 'LOCAL'
     }
     config['LOCAL'] = {
-        'SERVER_ADDRESS': 'YOUR_COMFYUI_URL'
+        'SERVER_ADDRESS': DEFAULT_SERVER_ADDRESS
+    }
+    config['LOCAL_TEXT2IMG'] = {
+        'CONFIG': './comfyUI-workflows/text2img_config.json',
+        'PROMPT_NODES': '6,12',
+        'NEG_PROMPT_NODES': '7,13',
+        'RAND_SEED_NODES': '17,20'
+    }
+    config['LOCAL_IMG2IMG'] = {
+        'CONFIG': './comfyUI-workflows/img2img_config.json',
+        'PROMPT_NODES': '2',
+        'NEG_PROMPT_NODES': '3',
+        'RAND_SEED_NODES': '4',
+        'FILE_INPUT_NODES': '5'
+    }
+    config['LOCAL_UPSCALE'] = {
+        'CONFIG': './comfyUI-workflows/upscale_config.json',
+        'FILE_INPUT_NODES': '1'
     }
     config['API'] = {
         'API_KEY': 'STABILITY_AI_API_KEY',
         'API_HOST': 'https://api.stability.ai',
         'API_IMAGE_ENGINE': 'STABILITY_AI_IMAGE_GEN_MODEL'
     }
+    config['SCHEDULER'] = {
+        'MAX_CONCURRENT': '1',
+        'MAX_QUEUE': '20',
+        'MAX_QUEUED_PER_USER': '3'
+    }
     with open('config.properties', 'w') as configfile:
         config.write(configfile)
 
-def create_collage(images):
-    num_images = len(images)
-    num_cols = ceil(sqrt(num_images))
-    num_rows = ceil(num_images / num_cols)
-    collage_width = max(image.width for image in images) * num_cols
-    collage_height = max(image.height for image in images) * num_rows
-    collage = Image.new('RGB', (collage_width, collage_height))
+def upload_limit(interaction):
+    if interaction.guild is not None:
+        return interaction.guild.filesize_limit
+    return DISCORD_UPLOAD_LIMIT
+
+def store_output(interaction, data, extension, kind, prompt, negative_prompt, images):
+    # Written in the background; the upload to Discord never waits on the disk
+    if output_store is None:
+        return
+    output_store.save(data, extension, kind,
+                      prompt=prompt, negative_prompt=negative_prompt, user_id=interaction.user.id,
+                      seed=[image.metadata.get('seed') for image in images],
+                      workflow=images[0].metadata.get('workflow'))
+
+async def collage_file(interaction, images, prompt, negative_prompt):
+    data, extension = await render_collage(images, upload_limit(interaction))
+    store_output(interaction, data, extension, 'collage', prompt, negative_prompt, images)
+    return discord.File(fp=BytesIO(data), filename=f'collage.{extension}')
 
-    for idx, image in enumerate(images):
-        row = idx // num_cols
-        col = idx % num_cols
-        x_offset = col * image.width
-        y_offset = row * image.height
-        collage.paste(image, (x_offset, y_offset))
+async def submit_job(interaction, priority, message):
+    # Admit the job before acknowledging the interaction, so a full queue is
+    # reported straight away instead of after the user has been told to wait
+    try:
+        job = scheduler.submit(interaction.user.id, priority)
+    except QueueFullError as e:
+        FAILURES.inc(stage='admission', error=type(e).__name__)
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return None, None
 
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    collage_path = f"./out/images_{timestamp}.png"
-    collage.save(collage_path)
+    # Queue position and generation progress share one throttled status message
+    progress = reporter.track(interaction, message, CancelButton(job.id))
+    progress.position = job.position
+    try:
+        await interaction.response.send_message(progress.content(), view=progress.view)
+    except Exception:
+        scheduler.abandon(job)
+        raise
 
-    return collage_path
+    async def show_position(position):
+        progress.update(position=position)
+    job.watch(show_position, progress.position)
+    active_jobs[job.id] = job
+    return job, progress
+
+class JobFailedError(Exception):
+    pass
+
+# Failures whose message is written for the user; anything else gets a generic apology
+USER_FACING_ERRORS = (BackendUnavailableError, PromptFailedError)
+
+async def run_job(job, progress, func, *args):
+    # Every way a job can end is shown on its status message. Failures are
+    # raised again as JobFailedError, from the original error.
+    try:
+        return await scheduler.run(job, func, *args, on_progress=progress)
+    except (JobCancelledError, ViewExpiredError) as e:
+        await progress.close(f"{progress.message}\n{e}")
+        raise
+    except Exception as e:
+        print(f"Job {job.id} failed: {e!r}")
+        reason = f"Sorry, that didn't work: {e}" if isinstance(e, USER_FACING_ERRORS) else "Sorry, something went wrong. Please try again later."
+        await progress.close(f"{progress.message}\n{reason}")
+        raise JobFailedError(reason) from e
+    finally:
+        active_jobs.pop(job.id, None)
+        await progress.close()
+
+async def send_result(interaction, **kwargs):
+    with stage('discord_send'):
+        await interaction.channel.send(**kwargs)
 
 # setting up the bot
-TOKEN, IMAGE_SOURCE = setup_config()
+# config.properties is read once, here, and handed to everything that needs it
+config = setup_config()
+TOKEN, IMAGE_SOURCE = config['BOT']['TOKEN'], config['BOT']['SDXL_SOURCE']
+enable_json_logs(config.getboolean('METRICS', 'JSON_LOGS', fallback=False))
 intents = discord.Intents.default() 
 client = discord.Client(intents=intents)
 tree = discord.app_commands.CommandTree(client)
+scheduler = setup_scheduler(config)
+setup_image_pipeline(config)
+output_store = setup_output_store(config)
+reporter = setup_progress_reporter(config)
+view_store = setup_view_store(config)
+# Jobs that can still be cancelled, by job id
+active_jobs = {}
 
+# Setup only reads the workflow files; connections are opened by warm_up
 if IMAGE_SOURCE == "LOCAL":
-    from imageGen import generate_images, upscale_image, generate_alternatives
+    import imageGen as image_source
 elif IMAGE_SOURCE == "API":
-    from apiImageGen import generate_images, upscale_image, generate_alternatives
+    import apiImageGen as image_source
+image_source.setup(config, setup_result_cache(config))
+generate_images = image_source.generate_images
+upscale_image = image_source.upscale_image
+generate_alternatives = image_source.generate_alternatives
+warm_up = image_source.warm_up
+
+# Hash of the slash commands as last synced, so unchanged commands aren't synced again
+COMMAND_HASH_FILE = 'command_tree.sha256'
+# Startup work that runs alongside the gateway connection
+startup_tasks = []
+
+def command_payload(command):
+    # discord.py 2.4 started passing the tree to to_dict()
+    if 'tree' in inspect.signature(command.to_dict).parameters:
+        return command.to_dict(tree)
+    return command.to_dict()
+
+def command_tree_hash():
+    commands = sorted((command_payload(command) for command in tree.get_commands()), key=lambda command: command['name'])
+    return hashlib.sha256(json.dumps([client.application_id, commands], sort_keys=True).encode()).hexdigest()
 
-# sync the slash command to your server
+async def sync_commands():
+    # Syncing is slow and globally rate limited, so it only happens when the
+    # commands have changed. Delete COMMAND_HASH_FILE to force a sync.
+    try:
+        tree_hash = command_tree_hash()
+    except Exception as e:
+        # Better an unneeded sync than commands that never get registered
+        print(f"Failed to hash the slash commands, syncing anyway: {e!r}")
+        tree_hash = None
+    if tree_hash is not None:
+        try:
+            with open(COMMAND_HASH_FILE) as file:
+                if file.read().strip() == tree_hash:
+                    return
+        except OSError:
+            pass
+    try:
+        await tree.sync()
+    except discord.HTTPException as e:
+        print(f"Failed to sync slash commands: {e}")
+        return
+    print("Synced slash commands")
+    if tree_hash is None:
+        return
+    try:
+        with open(COMMAND_HASH_FILE, 'w') as file:
+            file.write(tree_hash)
+    except OSError as e:
+        print(f"Failed to record the synced slash commands: {e}")
+
+def report_startup_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Startup task {task.get_name()} failed: {task.exception()!r}")
+
+def start_background(coro, name):
+    task = asyncio.create_task(coro, name=name)
+    task.add_done_callback(report_startup_failure)
+    startup_tasks.append(task)
+
+async def setup_hook():
+    # Runs once per process, after logging in and before connecting to the gateway
+    await setup_metrics(config)
+    start_background(sync_commands(), 'sync_commands')
+    start_background(warm_up(), 'warm_up')
+client.setup_hook = setup_hook
+
+# on_ready also fires after every reconnect, so nothing slow belongs here
 @client.event
 async def on_ready():
-    await tree.sync()
     print(f'Logged in as {client.user.name} ({client.user.id})')
 
-class ImageButton(discord.ui.Button):
-    def __init__(self, label, emoji, row, callback):
-        super().__init__(label=label, style=discord.ButtonStyle.grey, emoji=emoji, row=row)
-        self._callback = callback
-
-    async def callback(self, interaction: discord.Interaction):
-        await self._callback(interaction, self)
-
+# Button custom_ids are "sdxl:<action>:<view id>:<image index>", or "sdxl:C:<job id>:0" to cancel a job
+CUSTOM_ID_PREFIX = "sdxl"
 
 class Buttons(discord.ui.View):
-    def __init__(self, prompt, negative_prompt, images, *, timeout=180):
-        super().__init__(timeout=timeout)
-        self.prompt = prompt
-        self.negative_prompt = negative_prompt
-        self.images = images
+    # Only describes the buttons; their state is in view_store and clicks are
+    # routed by custom_id in on_interaction, so the buttons keep working after
+    # any timeout and across restarts
+    def __init__(self, view_id, image_count, reroll_disabled=False):
+        super().__init__(timeout=None)
+
+        self.add_item(discord.ui.Button(label="Re-roll", style=discord.ButtonStyle.green, emoji="🎲", row=0,
+                                        custom_id=f"{CUSTOM_ID_PREFIX}:R:{view_id}:0", disabled=reroll_disabled))
 
-        total_buttons = len(images) * 2 + 1  # For both alternative and upscale buttons + re-roll button
+        total_buttons = image_count * 2 + 1  # For both alternative and upscale buttons + re-roll button
         if total_buttons > 25:  # Limit to 25 buttons
-            images = images[:12]  # Adjust to only use the first 12 images
+            image_count = 12  # Adjust to only use the first 12 images
 
         # Determine if re-roll button should be on its own row
         reroll_row = 1 if total_buttons <= 21 else 0
 
         # Dynamically add alternative buttons
-        for idx, _ in enumerate(images):
+        for idx in range(image_count):
             row = (idx + 1) // 5 + reroll_row  # Determine row based on index and re-roll row
-            btn = ImageButton(f"V{idx + 1}", "♻️", row, self.generate_alternatives_and_send)
-            self.add_item(btn)
+            self.add_item(discord.ui.Button(label=f"V{idx + 1}", style=discord.ButtonStyle.grey, emoji="♻️", row=row,
+                                            custom_id=f"{CUSTOM_ID_PREFIX}:V:{view_id}:{idx}"))
 
         # Dynamically add upscale buttons
-        for idx, _ in enumerate(images):
-            row = (idx + len(images) + 1) // 5 + reroll_row  # Determine row based on index, number of alternative buttons, and re-roll row
-            btn = ImageButton(f"U{idx + 1}", "⬆️", row, self.upscale_and_send)
-            self.add_item(btn)
-
-    async def generate_alternatives_and_send(self, interaction, button):
-        index = int(button.label[1:]) - 1  # Extract index from label
-        await interaction.response.send_message("Creating some alternatives, this shouldn't take too long...")
-        images = await generate_alternatives(self.images[index], self.prompt, self.negative_prompt)
-        collage_path = create_collage(images)
+        for idx in range(image_count):
+            row = (idx + image_count + 1) // 5 + reroll_row  # Determine row based on index, number of alternative buttons, and re-roll row
+            self.add_item(discord.ui.Button(label=f"U{idx + 1}", style=discord.ButtonStyle.grey, emoji="⬆️", row=row,
+                                            custom_id=f"{CUSTOM_ID_PREFIX}:U:{view_id}:{idx}"))
+
+        # A stopped view isn't registered by discord.py when sent, so clicks only reach on_interaction
+        self.stop()
+
+class CancelButton(discord.ui.View):
+    # Shown under the status message until the job finishes
+    def __init__(self, job_id):
+        super().__init__(timeout=None)
+        self.add_item(discord.ui.Button(label="Cancel", style=discord.ButtonStyle.red, emoji="✖️",
+                                        custom_id=f"{CUSTOM_ID_PREFIX}:C:{job_id}:0"))
+        self.stop()
+
+async def cancel_job(interaction, job_id):
+    job = active_jobs.get(job_id)
+    if job is None:
+        await interaction.response.send_message("This job has already finished.", ephemeral=True)
+        return
+    if job.user_id != interaction.user.id:
+        await interaction.response.send_message("Only the person who started this job can cancel it.", ephemeral=True)
+        return
+    job.cancel()
+    await interaction.response.defer()
+
+async def buttons_for(prompt, negative_prompt, images):
+    view_id = await view_store.save(prompt, negative_prompt, images)
+    return Buttons(view_id, len(images))
+
+class ViewExpiredError(Exception):
+    pass
+
+EXPIRED_MESSAGE = "Sorry, these buttons have expired. Use /imagine to start again."
+
+# Errors run_job has already shown on the job's status message
+REPORTED_ERRORS = (JobCancelledError, ViewExpiredError, JobFailedError)
+
+# Views are only loaded once the click has been acknowledged, inside the job:
+# after a restart their images may have to be read from disk or fetched from ComfyUI
+async def load_view(view_id, index):
+    state = await view_store.load(view_id)
+    if state is None or index >= len(state.images):
+        raise ViewExpiredError(EXPIRED_MESSAGE)
+    return state
+
+async def load_view_image(state, index):
+    image = await view_store.image(state.images[index])
+    if image is None:
+        raise ViewExpiredError(EXPIRED_MESSAGE)
+    return image
+
+async def generate_alternatives_and_send(interaction, view_id, index):
+    job, progress = await submit_job(interaction, PRIORITY_VARIATION, "Creating some alternatives, this shouldn't take too long...")
+    if job is None:
+        return
+
+    async def alternatives(on_progress=None):
+        state = await load_view(view_id, index)
+        image = await load_view_image(state, index)
+        return state, await generate_alternatives(image, state.prompt, state.negative_prompt, on_progress=on_progress)
+
+    with track_job('variation', handled=REPORTED_ERRORS):
+        state, images = await run_job(job, progress, alternatives)
         final_message = f"{interaction.user.mention} here are your alternative images"
-        await interaction.channel.send(content=final_message, file=discord.File(fp=collage_path, filename='collage.png'), view=Buttons(self.prompt, self.negative_prompt, images))
-
-    async def upscale_and_send(self, interaction, button):
-        index = int(button.label[1:]) - 1  # Extract index from label
-        await interaction.response.send_message("Upscaling the image, this shouldn't take too long...")
-        upscaled_image = await upscale_image(self.images[index], self.prompt, self.negative_prompt)
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        upscaled_image_path = f"./out/upscaledImage_{timestamp}.png"
-        upscaled_image.save(upscaled_image_path)
+        await send_result(interaction, content=final_message, file=await collage_file(interaction, images, state.prompt, state.negative_prompt), view=await buttons_for(state.prompt, state.negative_prompt, images))
+
+async def upscale_and_send(interaction, view_id, index):
+    job, progress = await submit_job(interaction, PRIORITY_UPSCALE, "Upscaling the image, this shouldn't take too long...")
+    if job is None:
+        return
+
+    async def upscale(on_progress=None):
+        state = await load_view(view_id, index)
+        image = await load_view_image(state, index)
+        return state, await upscale_image(image, state.prompt, state.negative_prompt, on_progress=on_progress)
+
+    with track_job('upscale', handled=REPORTED_ERRORS):
+        state, upscaled_image = await run_job(job, progress, upscale)
+        data, extension = await render_image(upscaled_image, upload_limit(interaction))
+        store_output(interaction, upscaled_image.data, upscaled_image.extension, 'upscale', state.prompt, state.negative_prompt, [upscaled_image])
         final_message = f"{interaction.user.mention} here is your upscaled image"
-        await interaction.channel.send(content=final_message, file=discord.File(fp=upscaled_image_path, filename='upscaled_image.png'))
+        await send_result(interaction, content=final_message, file=discord.File(fp=BytesIO(data), filename=f'upscaled_image.{extension}'))
+
+async def reroll_image(interaction, view_id, index):
+    job, progress = await submit_job(interaction, PRIORITY_TEXT2IMG, f"{interaction.user.mention} asked me to re-imagine their prompt, this shouldn't take too long...")
+    if job is None:
+        return
 
-    @discord.ui.button(label="Re-roll", style=discord.ButtonStyle.green, emoji="🎲", row=0)
-    async def reroll_image(self, interaction, btn):
-        await interaction.response.send_message(f"{interaction.user.mention} asked me to re-imagine \"{self.prompt}\", this shouldn't take too long...")
-        btn.disabled = True
-        await interaction.message.edit(view=self)
+    async def reroll(on_progress=None):
+        state = await load_view(view_id, index)
+        progress.message = f"{interaction.user.mention} asked me to re-imagine \"{state.prompt}\", this shouldn't take too long..."
+        progress.update()
+        try:
+            await interaction.message.edit(view=Buttons(state.view_id, len(state.images), reroll_disabled=True))
+        except discord.HTTPException as e:
+            print(f"Failed to disable the re-roll button: {e}")
         # Generate a new image with the same prompt
-        images = await generate_images(self.prompt,self.negative_prompt)
+        return state, await generate_images(state.prompt, state.negative_prompt, on_progress=on_progress)
+
+    with track_job('reroll', handled=REPORTED_ERRORS):
+        state, images = await run_job(job, progress, reroll)
 
         # Construct the final message with user mention
-        final_message = f"{interaction.user.mention} asked me to re-imagine \"{self.prompt}\", here is what I imagined for them."
-        await interaction.channel.send(content=final_message, file=discord.File(fp=create_collage(images), filename='collage.png'), view = Buttons(self.prompt,self.negative_prompt,images))
+        final_message = f"{interaction.user.mention} asked me to re-imagine \"{state.prompt}\", here is what I imagined for them."
+        await send_result(interaction, content=final_message, file=await collage_file(interaction, images, state.prompt, state.negative_prompt), view=await buttons_for(state.prompt, state.negative_prompt, images))
+
+BUTTON_HANDLERS = {
+    'V': generate_alternatives_and_send,
+    'U': upscale_and_send,
+    'R': reroll_image,
+}
+
+@client.event
+async def on_interaction(interaction: discord.Interaction):
+    if interaction.type != discord.InteractionType.component:
+        return
+    parts = (interaction.data or {}).get('custom_id', '').split(':')
+    if len(parts) != 4 or parts[0] != CUSTOM_ID_PREFIX or not parts[3].isdigit():
+        return
+    _, action, view_id, index = parts
+    if action == 'C':
+        # Cancel buttons carry a job id instead of a view id
+        await cancel_job(interaction, view_id)
+        return
+    if action in BUTTON_HANDLERS:
+        await BUTTON_HANDLERS[action](interaction, view_id, int(index))
 
 @tree.command(name="imagine", description="Generate an image based on input text")
 @app_commands.describe(prompt='Prompt for the image being generated')
 @app_commands.describe(negative_prompt='Prompt for what you want to steer the AI away from')
 async def slash_command(interaction: discord.Interaction, prompt: str, negative_prompt: str = None):
     # Send an initial message
-    await interaction.response.send_message(f"{interaction.user.mention} asked me to imagine \"{prompt}\", this shouldn't take too long...")
+    job, progress = await submit_job(interaction, PRIORITY_TEXT2IMG, f"{interaction.user.mention} asked me to imagine \"{prompt}\", this shouldn't take too long...")
+    if job is None:
+        return
 
-    # Generate the image and get progress updates
-    images = await generate_images(prompt,negative_prompt)
+    with track_job('imagine', handled=REPORTED_ERRORS):
+        # Generate the image and get progress updates
+        images = await run_job(job, progress, generate_images, prompt, negative_prompt)
 
-    # Construct the final message with user mention
-    final_message = f"{interaction.user.mention} asked me to imagine \"{prompt}\", here is what I imagined for them."
-    await interaction.channel.send(content=final_message, file=discord.File(fp=create_collage(images), filename='collage.png'), view=Buttons(prompt,negative_prompt,images))
+        # Construct the final message with user mention
+        final_message = f"{interaction.user.mention} asked me to imagine \"{prompt}\", here is what I imagined for them."
+        await send_result(interaction, content=final_message, file=await collage_file(interaction, images, prompt, negative_prompt), view=await buttons_for(prompt, negative_prompt, images))
 
 # run the bot
-client.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    client.run(TOKEN)
\ No newline at end of file
@@ -0,0 +1,154 @@
+import asyncio
+from collections import OrderedDict
+
+import aiohttp
+
+from comfyConnection import ComfyConnection
+from comfyHttp import ComfyHttpClient
+from metrics import BACKEND_HEALTHY, BACKEND_IN_FLIGHT, BACKEND_QUEUE, stage
+
+HEALTH_CHECK_INTERVAL = 5
+CONNECT_TIMEOUT = 10
+# Consecutive failed health checks before a node's in-flight jobs are failed over
+MAX_FAILED_CHECKS = 2
+# Uploaded images remembered per node, keyed by content hash
+MAX_CACHED_UPLOADS = 512
+
+# Errors that mean the node itself is unreachable, as opposed to it rejecting the job
+BACKEND_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+class PromptFailedError(Exception):
+    # ComfyUI ran the prompt but it failed or produced nothing
+    pass
+
+
+class ComfyBackend:
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.connection = ComfyConnection(server_address)
+        self.http = ComfyHttpClient(server_address)
+        self.healthy = True
+        self.failed_checks = 0
+        self.in_flight = 0
+        self.queue_remaining = 0
+        self.vram_free = 0
+        self._external_load = 0
+        self._uploads = OrderedDict()
+
+    @property
+    def load(self):
+        # /queue counts every client's prompts, ours included; only the part we
+        # didn't send ourselves is added to our own live in-flight count
+        return self._external_load + self.in_flight
+
+    async def check_health(self):
+        try:
+            queue, stats = await asyncio.gather(self.http.get_queue(), self.http.get_system_stats())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.mark_unhealthy(e)
+            self.failed_checks += 1
+            if self.failed_checks == MAX_FAILED_CHECKS:
+                self.connection.notify_down()
+            return
+
+        self.queue_remaining = len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+        self._external_load = max(0, self.queue_remaining - self.in_flight)
+        self.vram_free = sum(device.get('vram_free', 0) for device in stats.get('devices', []))
+        self.failed_checks = 0
+        if not self.healthy:
+            print(f"ComfyUI backend {self.server_address} is back online")
+        self.healthy = True
+        BACKEND_QUEUE.set(self.queue_remaining, backend=self.server_address)
+        BACKEND_HEALTHY.set(1, backend=self.server_address)
+
+    async def image_input(self, image):
+        # Returns what to put in a LoadImage node for this GeneratedImage:
+        # a reference to the file if it was produced on this node, otherwise
+        # the name of an upload, which is done at most once per image content
+        if image.ref is not None and image.ref.server_address == self.server_address:
+            return image.ref.as_load_image_input()
+
+        upload = self._uploads.get(image.sha256)
+        if upload is None:
+            upload = asyncio.ensure_future(self.http.upload_image(image.data, f"{image.sha256}.png", overwrite=True))
+            self._uploads[image.sha256] = upload
+            while len(self._uploads) > MAX_CACHED_UPLOADS:
+                self._uploads.popitem(last=False)
+        else:
+            self._uploads.move_to_end(image.sha256)
+        try:
+            with stage('upload', 'local'):
+                response_data = await asyncio.shield(upload)
+        except BaseException:
+            if upload.done() and self._uploads.get(image.sha256) is upload:
+                del self._uploads[image.sha256]
+            raise
+        if response_data.get('subfolder'):
+            return f"{response_data['subfolder']}/{response_data['name']}"
+        return response_data['name']
+
+    def mark_unhealthy(self, reason):
+        # Stops new jobs being routed here until the next successful health check
+        if self.healthy:
+            print(f"ComfyUI backend {self.server_address} is unavailable: {reason}")
+        self.healthy = False
+        BACKEND_HEALTHY.set(0, backend=self.server_address)
+
+
+class BackendPool:
+    def __init__(self, server_addresses, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.backends = [ComfyBackend(address) for address in server_addresses]
+        self.health_check_interval = health_check_interval
+        self._health_task = None
+
+    def start(self):
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._check_health_forever())
+
+    async def _check_health_forever(self):
+        while True:
+            await asyncio.gather(*(backend.check_health() for backend in self.backends))
+            await asyncio.sleep(self.health_check_interval)
+
+    def choose(self, exclude=(), prefer=None):
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            raise BackendUnavailableError("No ComfyUI backend is available right now")
+        best = min(candidates, key=lambda backend: (backend.load, -backend.vram_free))
+        # Stick to the node that already has the input image unless it is
+        # noticeably busier than the best alternative
+        for backend in candidates:
+            if backend.server_address == prefer and backend.load <= best.load + 1:
+                return backend
+        return best
+
+    async def run(self, job, prefer=None):
+        # job is called with the chosen backend and must do all of its work
+        # (uploads included) against it; if the node dies the whole job is
+        # retried from scratch on the next least-loaded node
+        self.start()
+        tried = set()
+        while True:
+            backend = self.choose(exclude=tried, prefer=prefer)
+            backend.in_flight += 1
+            BACKEND_IN_FLIGHT.set(backend.in_flight, backend=backend.server_address)
+            try:
+                await backend.connection.start(timeout=CONNECT_TIMEOUT)
+                return await job(backend)
+            except BACKEND_ERRORS as e:
+                backend.mark_unhealthy(e)
+                error = e
+            except BackendUnavailableError as e:
+                error = e
+            finally:
+                backend.in_flight -= 1
+                BACKEND_IN_FLIGHT.set(backend.in_flight, backend=backend.server_address)
+            tried.add(backend)
+            if len(tried) == len(self.backends):
+                raise BackendUnavailableError(f"All ComfyUI backends failed, last error: {error!r}")
+            print(f"Job failed on {backend.server_address} ({error!r}), failing over")
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
+
+import websockets
+
+# Events that arrive before their prompt has been subscribed to (the HTTP
+# response to /prompt can lose the race against the websocket) are kept here
+# for a short while so the subscriber can replay them.
+MAX_UNCLAIMED_PROMPTS = 256
+MAX_UNCLAIMED_MESSAGES = 64
+
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 10
+
+
+class ComfyConnection:
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.uri = f"ws://{server_address}/ws?clientId={self.client_id}"
+        self.ws = None
+        self._listeners = {}
+        self._unclaimed = OrderedDict()
+        self._executing_prompt = None
+        self._executing_node = None
+        self._connected = asyncio.Event()
+        self._reader = None
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    @property
+    def executing_prompt(self):
+        # The prompt the server is running right now, if it is one of ours
+        return self._executing_prompt
+
+    async def start(self, timeout=None):
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._run())
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self.ws:
+            await self.ws.close()
+            self.ws = None
+        self._connected.clear()
+
+    def subscribe(self, prompt_id):
+        queue = asyncio.Queue()
+        for message in self._unclaimed.pop(prompt_id, []):
+            queue.put_nowait(message)
+        self._listeners[prompt_id] = queue
+        return queue
+
+    def unsubscribe(self, prompt_id):
+        self._listeners.pop(prompt_id, None)
+
+    async def _run(self):
+        delay = RECONNECT_DELAY
+        reconnecting = False
+        while True:
+            try:
+                # ComfyUI routes execution events by clientId, so reconnecting
+                # with the same id resubscribes us to every prompt still queued.
+                async with websockets.connect(self.uri, max_size=None) as ws:
+                    self.ws = ws
+                    self._connected.set()
+                    delay = RECONNECT_DELAY
+                    if reconnecting:
+                        self._notify_reconnected()
+                    async for out in ws:
+                        self._dispatch(out)
+            except asyncio.CancelledError:
+                raise
+            # WebSocketException also covers failed handshakes, e.g. a proxy
+            # answering 502 while ComfyUI restarts
+            except (websockets.WebSocketException, OSError) as e:
+                print(f"Lost connection to ComfyUI at {self.server_address} ({e}), reconnecting...")
+            finally:
+                self.ws = None
+                self._connected.clear()
+            reconnecting = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _notify_reconnected(self):
+        # Events emitted while we were disconnected are lost; let every waiter
+        # know so it can check /history for prompts that finished in the gap.
+        self._executing_prompt = None
+        self._executing_node = None
+        for queue in self._listeners.values():
+            queue.put_nowait({'type': 'reconnected', 'data': {}})
+
+    def notify_down(self):
+        # The server has been declared dead; waiters should give up on it
+        for queue in self._listeners.values():
+            queue.put_nowait({'type': 'backend_down', 'data': {}})
+
+    def _dispatch(self, out):
+        if isinstance(out, bytes):
+            # Binary frames (previews, websocket outputs) carry no prompt id and
+            # always belong to whatever is executing right now.
+            prompt_id = self._executing_prompt
+            message = {'type': 'binary', 'data': {
+                'prompt_id': prompt_id,
+                'node': self._executing_node,
+                'event': int.from_bytes(out[:4], 'big'),
+                'payload': out[4:],
+            }}
+        else:
+            try:
+                message = json.loads(out)
+            except ValueError:
+                print("Incompatible response from ComfyUI")
+                return
+            data = message.get('data') or {}
+            prompt_id = data.get('prompt_id')
+            if message['type'] == 'execution_start':
+                self._executing_prompt = prompt_id
+                self._executing_node = None
+            elif message['type'] == 'executing':
+                self._executing_node = data.get('node')
+                if data.get('node') is None and prompt_id == self._executing_prompt:
+                    self._executing_prompt = None
+            if prompt_id is None and message['type'] == 'progress':
+                prompt_id = self._executing_prompt
+
+        if prompt_id is None:
+            return
+
+        queue = self._listeners.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(message)
+        elif message['type'] != 'binary':
+            pending = self._unclaimed.setdefault(prompt_id, [])
+            self._unclaimed.move_to_end(prompt_id)
+            if len(pending) < MAX_UNCLAIMED_MESSAGES:
+                pending.append(message)
+            while len(self._unclaimed) > MAX_UNCLAIMED_PROMPTS:
+                self._unclaimed.popitem(last=False)
@@ -0,0 +1,118 @@
+import asyncio
+from io import BytesIO
+
+import aiohttp
+
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, sock_connect=5)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=5, sock_read=30)
+MAX_RETRIES = 3
+RETRY_DELAY = 0.5
+CHUNK_SIZE = 64 * 1024
+MAX_CONNECTIONS_PER_HOST = 16
+
+_session = None
+
+
+def get_session():
+    # A single keep-alive session is shared by every ComfyUI server we talk to;
+    # aiohttp pools connections per host underneath it.
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class ComfyHttpClient:
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.base_url = f"http://{server_address}"
+
+    async def _with_retries(self, send, idempotent=True, retries=MAX_RETRIES):
+        # Requests that change server state (queueing a prompt) are only retried
+        # when we never reached the server, so a job can't be queued twice.
+        delay = RETRY_DELAY
+        for attempt in range(retries + 1):
+            try:
+                return await send()
+            except aiohttp.ClientConnectorError:
+                if attempt == retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status >= 500
+                if not idempotent or not retryable or attempt == retries:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def _get_json(self, path, retries=MAX_RETRIES, **params):
+        async def send():
+            async with get_session().get(f"{self.base_url}{path}", params=params, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                return await response.json()
+        return await self._with_retries(send, retries=retries)
+
+    async def queue_prompt(self, prompt, client_id):
+        async def send():
+            p = {"prompt": prompt, "client_id": client_id}
+            async with get_session().post(f"{self.base_url}/prompt", json=p, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                return await response.json()
+        return await self._with_retries(send, idempotent=False)
+
+    async def _post_json(self, path, body, retries=MAX_RETRIES):
+        async def send():
+            async with get_session().post(f"{self.base_url}{path}", json=body, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+        await self._with_retries(send, retries=retries)
+
+    async def delete_queued(self, prompt_ids):
+        # Drops prompts that haven't started yet; ids that aren't queued are ignored
+        await self._post_json("/queue", {"delete": list(prompt_ids)}, retries=1)
+
+    async def interrupt(self, prompt_id=None):
+        # Newer ComfyUI versions only interrupt if prompt_id is the one running;
+        # older ones ignore the body and stop whatever is running
+        await self._post_json("/interrupt", {} if prompt_id is None else {"prompt_id": prompt_id}, retries=1)
+
+    async def get_image(self, filename, subfolder, folder_type, retries=MAX_RETRIES, timeout=DOWNLOAD_TIMEOUT):
+        async def send():
+            params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+            async with get_session().get(f"{self.base_url}/view", params=params, timeout=timeout) as response:
+                response.raise_for_status()
+                buffer = BytesIO()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    buffer.write(chunk)
+                return buffer.getvalue()
+        return await self._with_retries(send, retries=retries)
+
+    async def get_history(self, prompt_id):
+        return await self._get_json(f"/history/{prompt_id}")
+
+    # Health probes fail fast instead of retrying; the pool polls them anyway
+    async def get_queue(self):
+        return await self._get_json("/queue", retries=0)
+
+    async def get_system_stats(self):
+        return await self._get_json("/system_stats", retries=0)
+
+    async def upload_image(self, image_data, filename, subfolder=None, folder_type=None, overwrite=False):
+        async def send():
+            data = aiohttp.FormData()
+            data.add_field('image', image_data, filename=filename, content_type='image/png')
+            data.add_field('overwrite', str(overwrite).lower())
+            if subfolder:
+                data.add_field('subfolder', subfolder)
+            if folder_type:
+                data.add_field('type', folder_type)
+            async with get_session().post(f"{self.base_url}/upload/image", data=data, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                return await response.json()
+        return await self._with_retries(send)
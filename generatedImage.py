@@ -0,0 +1,58 @@
+import hashlib
+from io import BytesIO
+
+from PIL import Image
+
+
+class ImageRef:
+    # Where an image already lives on a ComfyUI server, as reported in /history
+    def __init__(self, server_address, filename, subfolder, folder_type):
+        self.server_address = server_address
+        self.filename = filename
+        self.subfolder = subfolder
+        self.folder_type = folder_type
+
+    def as_load_image_input(self):
+        # LoadImage accepts annotated paths such as "sub/name.png [output]" and
+        # reads them straight from that folder, so outputs never need re-uploading
+        path = f"{self.subfolder}/{self.filename}" if self.subfolder else self.filename
+        return f"{path} [{self.folder_type}]"
+
+
+class GeneratedImage:
+    # An encoded image as a backend returned it. Pixels are only decoded when
+    # something needs them, and the original bytes are reused for uploads.
+    def __init__(self, data, ref=None, image=None, metadata=None):
+        self.data = data
+        self.ref = ref
+        # How the image was made (workflow, seed), recorded alongside stored outputs
+        self.metadata = metadata or {}
+        self._image = image
+        self._sha256 = None
+
+    @classmethod
+    def from_pil(cls, image):
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        return cls(buffered.getvalue(), image=image)
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def extension(self):
+        if self.data.startswith(b'\xff\xd8'):
+            return 'jpg'
+        if self.data[:4] == b'RIFF' and self.data[8:12] == b'WEBP':
+            return 'webp'
+        return 'png'
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.data))
+            self._image.load()
+        return self._image
@@ -0,0 +1,27 @@
+from collections import OrderedDict
+
+
+class ImageCache:
+    # Lists of GeneratedImages by key, least recently used dropped first once
+    # the byte budget is exceeded. Only the encoded bytes count towards it;
+    # callers store fresh GeneratedImages so no decoded pixels are kept alive.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        images = self._entries.get(key)
+        if images is not None:
+            self._entries.move_to_end(key)
+        return images
+
+    def put(self, key, images):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = images
+        self.total_bytes += sum(len(image.data) for image in images)
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= sum(len(image.data) for image in evicted)
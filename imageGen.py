@@ -1,196 +1,212 @@
-import websockets
-import uuid
-import json
-import random
-import urllib.request
-import urllib.parse
-from PIL import Image
-from io import BytesIO
-import configparser
-import os
-import tempfile
-import requests
-
-# Read the configuration
-config = configparser.ConfigParser()
-config.read('config.properties')
-server_address = config['LOCAL']['SERVER_ADDRESS']
-text2img_config = config['LOCAL_TEXT2IMG']['CONFIG']
-img2img_config = config['LOCAL_IMG2IMG']['CONFIG']
-upscale_config = config['LOCAL_UPSCALE']['CONFIG']
-
-def queue_prompt(prompt, client_id):
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req =  urllib.request.Request("http://{}/prompt".format(server_address), data=data)
-    return json.loads(urllib.request.urlopen(req).read())
-
-def get_image(filename, subfolder, folder_type):
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
-        return response.read()
-
-def get_history(prompt_id):
-    with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
-        return json.loads(response.read())
-    
-def upload_image(filepath, subfolder=None, folder_type=None, overwrite=False):
-    url = f"http://{server_address}/upload/image"
-    files = {'image': open(filepath, 'rb')}
-    data = {
-        'overwrite': str(overwrite).lower()
-    }
-    if subfolder:
-        data['subfolder'] = subfolder
-    if folder_type:
-        data['type'] = folder_type
-    response = requests.post(url, files=files, data=data)
-    return response.json()
+import asyncio
+import time
+
+import aiohttp
+
+from generatedImage import GeneratedImage, ImageRef
+from comfyBackends import BACKEND_ERRORS, CONNECT_TIMEOUT, BackendPool, BackendUnavailableError, HEALTH_CHECK_INTERVAL, PromptFailedError
+from metrics import observe_stage, stage
+from promptBatcher import PromptBatcher
+from workflowTemplates import TemplateRegistry
+
+# All set by setup() from the bot's config
+templates = None
+backends = None
+batcher = None
+warm_up_models = False
+# Results of deterministic workflows, None when [CACHE] is disabled
+result_cache = None
+
+def setup(config, cache=None):
+    global templates, backends, batcher, warm_up_models, result_cache
+    result_cache = cache
+    server_addresses = [address.strip() for address in config['LOCAL']['SERVER_ADDRESS'].split(',') if address.strip()]
+
+    # Workflows are parsed and their configured nodes validated once, here; jobs get patched copies
+    templates = TemplateRegistry()
+    templates.register('text2img', config['LOCAL_TEXT2IMG'])
+    templates.register('img2img', config['LOCAL_IMG2IMG'])
+    templates.register('upscale', config['LOCAL_UPSCALE'])
+
+    # Every ComfyUI server gets one websocket and one pooled HTTP client, shared by every job in flight
+    backends = BackendPool(server_addresses, config.getfloat('LOCAL', 'HEALTH_CHECK_INTERVAL', fallback=HEALTH_CHECK_INTERVAL))
+    # Run the text2img workflow once on every server at startup, so the first job doesn't wait for models to load
+    warm_up_models = config.getboolean('LOCAL', 'WARMUP', fallback=False)
+
+    # Concurrent text2img jobs with the same prompt can be rendered as one larger
+    # latent batch; off unless a window and the batch size nodes are set
+    batch_window = config.getfloat('LOCAL_TEXT2IMG', 'BATCH_WINDOW_MS', fallback=0) / 1000
+    batcher = None
+    if batch_window > 0 and templates.get('text2img').batch_size_nodes:
+        batcher = PromptBatcher(run_batched_prompt, batch_window, config.getint('LOCAL_TEXT2IMG', 'MAX_BATCH', fallback=4))
+
+# Binary websocket event carrying a latent preview (or a SaveImageWebsocket output)
+PREVIEW_IMAGE = 1
 
 class ImageGenerator:
-    def __init__(self):
-        self.client_id = str(uuid.uuid4())
-        self.uri = f"ws://{server_address}/ws?clientId={self.client_id}"
-        self.ws = None
-
-    async def connect(self):
-        self.ws = await websockets.connect(self.uri)
-
-    async def get_images(self, prompt):
-        if not self.ws:
-            await self.connect()
-    
-        prompt_id = queue_prompt(prompt, self.client_id)['prompt_id']
-        currently_Executing_Prompt = None
-        output_images = []
-        async for out in self.ws:
-            try:
-                message = json.loads(out)
+    def __init__(self, backend):
+        self.backend = backend
+        self.connection = backend.connection
+        self.http = backend.http
+
+    async def get_images(self, prompt, websocket_output_nodes=(), metadata=None, on_progress=None):
+        outputs = await self.get_outputs(prompt, websocket_output_nodes, on_progress)
+        images = [image for node_images in outputs.values() for image in node_images]
+        for image in images:
+            image.metadata = dict(metadata or {})
+        return images
+
+    async def get_outputs(self, prompt, websocket_output_nodes=(), on_progress=None):
+        # Returns the final images of a prompt grouped by the node that saved them
+        queued_at = time.perf_counter()
+        started_at = None
+        prompt_id = (await self.http.queue_prompt(prompt, self.connection.client_id))['prompt_id']
+        events = self.connection.subscribe(prompt_id)
+        streamed_images = {}
+        error = None
+        try:
+            while True:
+                message = await events.get()
+                if message['type'] == 'execution_error':
+                    # ComfyUI still reports the prompt as finished afterwards
+                    error = message['data'].get('exception_message') or 'unknown error'
                 if message['type'] == 'execution_start':
-                    currently_Executing_Prompt = message['data']['prompt_id']
-                if message['type'] == 'executing' and prompt_id == currently_Executing_Prompt:
-                    data = message['data']
-                    if data['node'] is None and data['prompt_id'] == prompt_id:
-                        break
-            except ValueError as e:
-                print("Incompatible response from ComfyUI");
-                
-        history = get_history(prompt_id)[prompt_id]
-
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                for image in node_output['images']:
-                    image_data = get_image(image['filename'], image['subfolder'], image['type'])
-                    if 'final_output' in image['filename']:
-                        pil_image = Image.open(BytesIO(image_data))
-                        output_images.append(pil_image)
-
-        return output_images
-
-    async def close(self):
-        if self.ws:
-            await self.ws.close()
-
-async def generate_images(prompt: str,negative_prompt: str):
-    with open(text2img_config, 'r') as file:
-      workflow = json.load(file)
-      
-    generator = ImageGenerator()
-    await generator.connect()
-
-    prompt_nodes = config.get('LOCAL_TEXT2IMG', 'PROMPT_NODES').split(',')
-    neg_prompt_nodes = config.get('LOCAL_TEXT2IMG', 'NEG_PROMPT_NODES').split(',')
-    rand_seed_nodes = config.get('LOCAL_TEXT2IMG', 'RAND_SEED_NODES').split(',') 
-
-    # Modify the prompt dictionary
-    if(prompt != None and prompt_nodes[0] != ''):
-      for node in prompt_nodes:
-          workflow[node]["inputs"]["text"] = prompt
-    if(negative_prompt != None and neg_prompt_nodes[0] != ''):
-      for node in neg_prompt_nodes:
-          workflow[node]["inputs"]["text"] = negative_prompt
-    if(rand_seed_nodes[0] != ''):
-      for node in rand_seed_nodes:
-          workflow[node]["inputs"]["seed"] = random.randint(0,999999999999999)
-
-    images = await generator.get_images(workflow)
-    await generator.close()
+                    started_at = time.perf_counter()
+                    observe_stage('backend_queue_wait', started_at - queued_at, 'local')
+                if message['type'] == 'executing' and message['data']['node'] is None:
+                    if started_at is not None:
+                        observe_stage('execution', time.perf_counter() - started_at, 'local')
+                    break
+                if message['type'] == 'binary' and message['data']['node'] in websocket_output_nodes:
+                    # SaveImageWebsocket frames: 4 byte image format, then the encoded image
+                    streamed_images.setdefault(message['data']['node'], []).append(GeneratedImage(message['data']['payload'][4:]))
+                elif message['type'] == 'binary' and message['data']['event'] == PREVIEW_IMAGE and on_progress:
+                    on_progress(preview=message['data']['payload'][4:])
+                if message['type'] == 'progress' and on_progress:
+                    on_progress(step=message['data']['value'], total=message['data']['max'])
+                if message['type'] == 'reconnected' and prompt_id in await self.http.get_history(prompt_id):
+                    break
+                if message['type'] == 'backend_down':
+                    raise BackendUnavailableError(f"Lost ComfyUI backend {self.backend.server_address}")
+        except asyncio.CancelledError:
+            await self.cancel(prompt_id)
+            raise
+        finally:
+            self.connection.unsubscribe(prompt_id)
+
+        if error is not None:
+            raise PromptFailedError(f"ComfyUI failed to run the workflow: {error.strip()}")
+        if streamed_images:
+            return streamed_images
+
+        with stage('output_fetch', 'local'):
+            history = (await self.http.get_history(prompt_id))[prompt_id]
+
+            # Only the final outputs are downloaded, all at once
+            wanted = [(node_id, image) for node_id, node_output in history['outputs'].items()
+                      for image in node_output.get('images', [])
+                      if 'final_output' in image['filename']]
+            image_data = await asyncio.gather(*(self.http.get_image(image['filename'], image['subfolder'], image['type']) for node_id, image in wanted))
+
+        outputs = {}
+        for (node_id, image), data in zip(wanted, image_data):
+            ref = ImageRef(self.backend.server_address, image['filename'], image['subfolder'], image['type'])
+            outputs.setdefault(node_id, []).append(GeneratedImage(data, ref=ref))
+        if not outputs:
+            raise PromptFailedError("ComfyUI finished the workflow without saving any final images")
+
+        return outputs
+
+    async def cancel(self, prompt_id):
+        # Nobody is waiting for this prompt any more, so free the GPU for live jobs:
+        # take it out of the queue, or stop it if it is already running
+        try:
+            if self.connection.executing_prompt != prompt_id:
+                await self.http.delete_queued([prompt_id])
+            # It may have started while the delete was in flight
+            if self.connection.executing_prompt == prompt_id:
+                await self.http.interrupt(prompt_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Failed to cancel prompt {prompt_id} on {self.backend.server_address}: {e!r}")
+
+async def run_batched_prompt(workflow, websocket_output_nodes, on_progress):
+    async def run(backend):
+        generator = ImageGenerator(backend)
+        return await generator.get_outputs(workflow, websocket_output_nodes, on_progress)
+    return await backends.run(run)
+
+async def cached(template, render, **values):
+    # A workflow without random seeds renders the same inputs the same way,
+    # so its results are shared through the result cache
+    if result_cache is None or not template.deterministic:
+        return await render()
+    return await result_cache.run(template.cache_key(**values), render)
+
+async def generate_images(prompt: str,negative_prompt: str, on_progress=None):
+    template = templates.get('text2img')
+
+    async def render():
+        workflow = template.build(prompt=prompt, negative_prompt=negative_prompt)
+
+        if batcher is not None:
+            metadata = {'workflow': 'text2img', 'seed': template.seed(workflow)}
+            return await batcher.submit(template, workflow, (prompt, negative_prompt), metadata, on_progress)
+
+        async def run(backend):
+            generator = ImageGenerator(backend)
+            return await generator.get_images(workflow, template.websocket_output_nodes, {'workflow': 'text2img', 'seed': template.seed(workflow)}, on_progress)
+        return await backends.run(run)
+    images = await cached(template, render, prompt=prompt, negative_prompt=negative_prompt)
 
     return images
 
-async def generate_alternatives(image: Image.Image, prompt: str, negative_prompt: str):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-      image.save(temp_file, format="PNG")
-      temp_filepath = temp_file.name
-
-    # Upload the temporary file using the upload_image method
-    response_data = upload_image(temp_filepath)
-    filename = response_data['name']
-    with open(img2img_config, 'r') as file:
-      workflow = json.load(file)
-      
-    generator = ImageGenerator()
-    await generator.connect()
-
-    prompt_nodes = config.get('LOCAL_IMG2IMG', 'PROMPT_NODES').split(',')
-    neg_prompt_nodes = config.get('LOCAL_IMG2IMG', 'NEG_PROMPT_NODES').split(',')
-    rand_seed_nodes = config.get('LOCAL_IMG2IMG', 'RAND_SEED_NODES').split(',') 
-    file_input_nodes = config.get('LOCAL_IMG2IMG', 'FILE_INPUT_NODES').split(',') 
-
-    if(prompt != None and prompt_nodes[0] != ''):
-      for node in prompt_nodes:
-          workflow[node]["inputs"]["text"] = prompt
-    if(negative_prompt != None and neg_prompt_nodes[0] != ''):
-      for node in neg_prompt_nodes:
-          workflow[node]["inputs"]["text"] = negative_prompt
-    if(rand_seed_nodes[0] != ''):
-      for node in rand_seed_nodes:
-          workflow[node]["inputs"]["seed"] = random.randint(0,999999999999999)
-    if(file_input_nodes[0] != ''):
-      for node in file_input_nodes:
-          workflow[node]["inputs"]["image"] = filename
-
-    images = await generator.get_images(workflow)
-    await generator.close()
+async def generate_alternatives(image: GeneratedImage, prompt: str, negative_prompt: str, on_progress=None):
+    template = templates.get('img2img')
+
+    async def run(backend):
+        filename = await backend.image_input(image)
+        workflow = template.build(prompt=prompt, negative_prompt=negative_prompt, image=filename)
+
+        generator = ImageGenerator(backend)
+        return await generator.get_images(workflow, template.websocket_output_nodes, {'workflow': 'img2img', 'seed': template.seed(workflow)}, on_progress)
+    images = await cached(template, lambda: backends.run(run, prefer=image.ref.server_address if image.ref else None),
+                          prompt=prompt, negative_prompt=negative_prompt, image=image.sha256)
 
     return images
 
-async def upscale_image(image: Image.Image, prompt: str,negative_prompt: str):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-      image.save(temp_file, format="PNG")
-      temp_filepath = temp_file.name
-
-    # Upload the temporary file using the upload_image method
-    response_data = upload_image(temp_filepath)
-    filename = response_data['name']
-    with open(upscale_config, 'r') as file:
-      workflow = json.load(file)
-
-    generator = ImageGenerator()
-    await generator.connect()
-
-    prompt_nodes = config.get('LOCAL_UPSCALE', 'PROMPT_NODES').split(',')
-    neg_prompt_nodes = config.get('LOCAL_UPSCALE', 'NEG_PROMPT_NODES').split(',')
-    rand_seed_nodes = config.get('LOCAL_UPSCALE', 'RAND_SEED_NODES').split(',') 
-    file_input_nodes = config.get('LOCAL_UPSCALE', 'FILE_INPUT_NODES').split(',') 
-
-    # Modify the prompt dictionary
-    if(prompt != None and prompt_nodes[0] != ''):
-      for node in prompt_nodes:
-          workflow[node]["inputs"]["text"] = prompt
-    if(negative_prompt != None and neg_prompt_nodes[0] != ''):
-      for node in neg_prompt_nodes:
-          workflow[node]["inputs"]["text"] = negative_prompt
-    if(rand_seed_nodes[0] != ''):
-      for node in rand_seed_nodes:
-          workflow[node]["inputs"]["seed"] = random.randint(0,999999999999999)
-    if(file_input_nodes[0] != ''):
-      for node in file_input_nodes:
-          workflow[node]["inputs"]["image"] = filename
-
-    images = await generator.get_images(workflow)
-    await generator.close()
-
-    return images[0]
\ No newline at end of file
+async def upscale_image(image: GeneratedImage, prompt: str, negative_prompt: str, on_progress=None):
+    template = templates.get('upscale')
+
+    async def run(backend):
+        filename = await backend.image_input(image)
+        workflow = template.build(prompt=prompt, negative_prompt=negative_prompt, image=filename)
+
+        generator = ImageGenerator(backend)
+        return await generator.get_images(workflow, template.websocket_output_nodes, {'workflow': 'upscale', 'seed': template.seed(workflow)}, on_progress)
+    images = await cached(template, lambda: backends.run(run, prefer=image.ref.server_address if image.ref else None),
+                          prompt=prompt, negative_prompt=negative_prompt, image=image.sha256)
+
+    return images[0]
+
+async def warm_up_backend(backend):
+    try:
+        await backend.connection.start(timeout=CONNECT_TIMEOUT)
+    except BACKEND_ERRORS as e:
+        backend.mark_unhealthy(e)
+        return
+    if not warm_up_models:
+        return
+
+    template = templates.get('text2img')
+    try:
+        await ImageGenerator(backend).get_outputs(template.build(prompt='', negative_prompt=''), template.websocket_output_nodes)
+    except (BackendUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Failed to warm up ComfyUI backend {backend.server_address}: {e!r}")
+        return
+    print(f"Warmed up ComfyUI backend {backend.server_address}")
+
+async def warm_up():
+    # Started in the background while the bot connects to Discord: opens the
+    # websocket to every server now rather than on the first job
+    backends.start()
+    await asyncio.gather(*(warm_up_backend(backend) for backend in backends.backends))
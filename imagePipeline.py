@@ -0,0 +1,93 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from math import ceil, sqrt
+
+from PIL import Image
+
+from metrics import stage
+
+# Discord's attachment limit for servers without boosts; guilds report their own
+DISCORD_UPLOAD_LIMIT = 25 * 1024 * 1024
+
+# Tried in order until the encoded image fits the upload limit
+ENCODINGS = [
+    ('png', 'PNG', {}),
+    ('webp', 'WEBP', {'quality': 90, 'method': 4}),
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 85, 'optimize': True}),
+    ('jpg', 'JPEG', {'quality': 70, 'optimize': True}),
+]
+
+# Set up by the bot from [OUTPUT] WORKERS
+executor = None
+
+
+def setup_executor(workers):
+    # Pillow releases the GIL while resizing and encoding, so threads keep the
+    # event loop free without having to pickle images across processes
+    global executor
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-pipeline')
+
+
+def run_in_executor(func, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def create_collage(images):
+    num_images = len(images)
+    num_cols = ceil(sqrt(num_images))
+    num_rows = ceil(num_images / num_cols)
+    cell_width = max(image.width for image in images)
+    cell_height = max(image.height for image in images)
+    collage = Image.new('RGB', (cell_width * num_cols, cell_height * num_rows))
+
+    for idx, image in enumerate(images):
+        row = idx // num_cols
+        col = idx % num_cols
+        collage.paste(image, (col * cell_width, row * cell_height))
+
+    return collage
+
+
+def encode_image(image, size_limit):
+    # Returns (encoded bytes, file extension) for the best quality encoding
+    # that fits in size_limit, shrinking the image as a last resort
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    while True:
+        for extension, image_format, options in ENCODINGS:
+            buffered = BytesIO()
+            image.save(buffered, format=image_format, **options)
+            if buffered.tell() <= size_limit:
+                return buffered.getvalue(), extension
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+
+
+def _decode_images(images):
+    return [image.image for image in images]
+
+
+def _render_collage(images, size_limit):
+    collage = create_collage([image.image for image in images])
+    return encode_image(collage, size_limit)
+
+
+def _render_image(image, size_limit):
+    # Backend outputs are already encoded; only re-encode when they're too big
+    if len(image.data) <= size_limit:
+        return image.data, image.extension
+    return encode_image(image.image, size_limit)
+
+
+async def render_collage(images, size_limit=DISCORD_UPLOAD_LIMIT):
+    # Decoding is timed on its own so it isn't mistaken for encoding cost
+    with stage('decode'):
+        await run_in_executor(_decode_images, images)
+    with stage('encode'):
+        return await run_in_executor(_render_collage, images, size_limit)
+
+
+async def render_image(image, size_limit=DISCORD_UPLOAD_LIMIT):
+    with stage('encode'):
+        return await run_in_executor(_render_image, image, size_limit)
@@ -0,0 +1,194 @@
+import asyncio
+import uuid
+from collections import OrderedDict, deque
+
+from metrics import stage
+
+# Lower runs first, so cheap upscales never wait behind heavy text2img jobs
+PRIORITY_UPSCALE = 0
+PRIORITY_VARIATION = 1
+PRIORITY_TEXT2IMG = 2
+PRIORITIES = (PRIORITY_UPSCALE, PRIORITY_VARIATION, PRIORITY_TEXT2IMG)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class JobTimeoutError(JobCancelledError):
+    pass
+
+
+class Job:
+    def __init__(self, user_id, priority):
+        self.id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.priority = priority
+        self.position = None
+        self.on_position = None
+        self.started = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+        self.task = None
+        self._reported_position = None
+        self._notifier = None
+
+    @property
+    def queued(self):
+        return not self.started.done()
+
+    def cancel(self):
+        # Stops the job wherever it is: waiting in the queue, or running,
+        # in which case the backend is told to drop its work too
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def watch(self, on_position, shown_position):
+        # on_position is awaited whenever the job's place in the queue differs
+        # from what the user was last shown; None means the job has started
+        self.on_position = on_position
+        self._reported_position = shown_position
+        self._notify()
+
+    def _notify(self):
+        # Position changes are coalesced: at most one update per job is in
+        # flight, and it always reports the latest position when it runs
+        if self.on_position is None or (self._notifier is not None and not self._notifier.done()):
+            return
+        if self._reported_position != self.position:
+            self._notifier = asyncio.create_task(self._send_position())
+
+    async def _send_position(self):
+        while self._reported_position != self.position:
+            position = self.position
+            try:
+                await self.on_position(position)
+            except Exception as e:
+                print(f"Failed to update queue position: {e}")
+                return
+            self._reported_position = position
+
+
+class JobScheduler:
+    def __init__(self, max_concurrent=1, max_queue=20, max_queued_per_user=3, job_timeout=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        # Seconds a job may take from the moment it is run, queueing included
+        self.job_timeout = job_timeout
+        self.running = 0
+        self.queued = 0
+        # priority -> user id -> that user's waiting jobs; users rotate to the
+        # back of the OrderedDict each time one of their jobs is started
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+
+    def submit(self, user_id, priority):
+        job = Job(user_id, priority)
+        if self.running < self.max_concurrent and self.queued == 0:
+            self.running += 1
+            job.started.set_result(None)
+            return job
+
+        if self.queued >= self.max_queue:
+            raise QueueFullError("The queue is full right now, please try again in a little while.")
+        user_jobs = sum(len(users.get(user_id, ())) for users in self._queues.values())
+        if user_jobs >= self.max_queued_per_user:
+            raise QueueFullError(f"You already have {user_jobs} jobs waiting, please wait for them to finish.")
+
+        self._queues[priority].setdefault(user_id, deque()).append(job)
+        self.queued += 1
+        self._update_positions()
+        return job
+
+    async def run(self, job, func, *args, **kwargs):
+        # Raises JobCancelledError if job.cancel() was called and
+        # JobTimeoutError if the job outlived job_timeout
+        if job.cancelled:
+            self.abandon(job)
+            raise JobCancelledError("This job was cancelled.")
+        job.task = asyncio.ensure_future(self._run(job, func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(job.task, self.job_timeout)
+        except asyncio.TimeoutError:
+            if not job.task.cancelled():
+                raise
+            raise JobTimeoutError(f"This job took longer than {self.job_timeout:g} seconds and was cancelled.") from None
+        except asyncio.CancelledError:
+            if job.cancelled and job.task.cancelled():
+                raise JobCancelledError("This job was cancelled.") from None
+            raise
+
+    async def _run(self, job, func, *args, **kwargs):
+        try:
+            with stage('scheduler_wait'):
+                await asyncio.shield(job.started)
+        except asyncio.CancelledError:
+            self.abandon(job)
+            raise
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self._release()
+
+    def abandon(self, job):
+        # For jobs that were submitted but will never run
+        if job.queued:
+            self._remove(job)
+        else:
+            self._release()
+
+    def queue_order(self):
+        # The order queued jobs would start in if nothing else arrived:
+        # priority classes in turn, round-robin across users within each
+        order = []
+        for priority in PRIORITIES:
+            user_jobs = [list(jobs) for jobs in self._queues[priority].values()]
+            for idx in range(max((len(jobs) for jobs in user_jobs), default=0)):
+                order.extend(jobs[idx] for jobs in user_jobs if idx < len(jobs))
+        return order
+
+    def _remove(self, job):
+        if not job.queued:
+            return
+        users = self._queues[job.priority]
+        jobs = users.get(job.user_id)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del users[job.user_id]
+            self.queued -= 1
+            job.started.cancel()
+            self._update_positions()
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self.queued:
+            for priority in PRIORITIES:
+                users = self._queues[priority]
+                if users:
+                    break
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            self.queued -= 1
+            self.running += 1
+            job.position = None
+            job.started.set_result(None)
+            job._notify()
+        self._update_positions()
+
+    def _update_positions(self):
+        for position, job in enumerate(self.queue_order(), start=1):
+            if job.position != position:
+                job.position = position
+                job._notify()
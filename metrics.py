@@ -0,0 +1,204 @@
+import contextvars
+import itertools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Whether log_event writes JSON lines; set by the bot from [METRICS] JSON_LOGS
+json_logs = False
+
+# Seconds; covers everything from a cache hit to a slow SDXL refine
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The job the running task is working on, for tagging stage timings and log lines
+current_job = contextvars.ContextVar('current_job', default=None)
+_job_ids = itertools.count(1)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        # Image workers record into the same metrics as the event loop
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines = []
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {counts[-1]}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-2]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+STAGE_SECONDS = registry.add(Histogram('sdxl_bot_stage_seconds', 'Time spent in each stage of a job', ('stage', 'source')))
+JOB_SECONDS = registry.add(Histogram('sdxl_bot_job_seconds', 'End to end time of a job, queueing included', ('kind',)))
+JOBS = registry.add(Counter('sdxl_bot_jobs_total', 'Finished jobs by outcome', ('kind', 'outcome')))
+JOBS_IN_FLIGHT = registry.add(Gauge('sdxl_bot_jobs_in_flight', 'Jobs accepted and not yet finished', ('kind',)))
+FAILURES = registry.add(Counter('sdxl_bot_failures_total', 'Failed stages by error type', ('stage', 'error')))
+BACKEND_IN_FLIGHT = registry.add(Gauge('sdxl_bot_backend_in_flight', 'Prompts this bot has running on each ComfyUI server', ('backend',)))
+BACKEND_QUEUE = registry.add(Gauge('sdxl_bot_backend_queue', 'Prompts queued on each ComfyUI server, from every client', ('backend',)))
+CACHE_LOOKUPS = registry.add(Counter('sdxl_bot_cache_lookups_total', 'Result cache lookups by where the result came from', ('result',)))
+BACKEND_HEALTHY = registry.add(Gauge('sdxl_bot_backend_healthy', 'Whether each ComfyUI server passed its last health check', ('backend',)))
+
+
+def log_event(event, **fields):
+    if not json_logs:
+        return
+    job = current_job.get()
+    if job is not None:
+        fields = dict(job=job['id'], kind=job['kind'], **fields)
+    print(json.dumps(dict(ts=round(time.time(), 3), event=event, **fields), default=str), flush=True)
+
+
+def observe_stage(name, seconds, source='bot'):
+    STAGE_SECONDS.observe(seconds, stage=name, source=source)
+    log_event('stage', stage=name, source=source, seconds=round(seconds, 4))
+
+
+@contextmanager
+def stage(name, source='bot'):
+    # Times the enclosed block, awaits included, as one stage of the current job
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        FAILURES.inc(stage=name, error=type(e).__name__)
+        log_event('stage', stage=name, source=source, seconds=round(time.perf_counter() - start, 4), error=type(e).__name__)
+        raise
+    observe_stage(name, time.perf_counter() - start, source)
+
+
+@contextmanager
+def track_job(kind, handled=()):
+    # Wraps a whole job from the moment it is accepted until its result has been sent.
+    # Exceptions in handled have already been reported to the user; they are
+    # counted as the job's outcome, under the name of the error they were
+    # raised from if any, and not raised any further.
+    token = current_job.set({'id': next(_job_ids), 'kind': kind})
+    JOBS_IN_FLIGHT.inc(kind=kind)
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except handled as e:
+        outcome = type(e.__cause__ or e).__name__
+    except BaseException as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        JOBS_IN_FLIGHT.dec(kind=kind)
+        JOBS.inc(kind=kind, outcome=outcome)
+        JOB_SECONDS.observe(seconds, kind=kind)
+        log_event('job', outcome=outcome, seconds=round(seconds, 4))
+        current_job.reset(token)
+
+
+def enable_json_logs(enabled=True):
+    global json_logs
+    json_logs = enabled
+
+
+async def start_server(host='127.0.0.1', port=9100):
+    # Serves GET /metrics in the Prometheus text format
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
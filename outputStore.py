@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from sqliteStore import SqliteStore
+
+
+class OutputStore(SqliteStore):
+    # Results on disk are named by the SHA-256 of their content, so identical
+    # outputs are stored once and concurrent jobs can never overwrite each
+    # other. A small SQLite index records what each file is and when it was
+    # last used; the least recently used files are evicted once the size or
+    # age budget is exceeded.
+    database = 'index.db'
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS outputs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            kind TEXT,
+            prompt TEXT,
+            negative_prompt TEXT,
+            user_id TEXT,
+            seed TEXT,
+            workflow TEXT,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL)''',
+        'CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs (last_access)',
+        'CREATE INDEX IF NOT EXISTS outputs_prompt ON outputs (prompt)',
+        'CREATE INDEX IF NOT EXISTS outputs_user ON outputs (user_id)',
+    )
+    thread_name = 'output-store'
+
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        super().__init__(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.total_bytes = 0
+
+    def save(self, data, extension, kind, **metadata):
+        # Returns a future for the content hash; callers don't have to wait for the write
+        return self._run(self._save, data, extension, kind, metadata)
+
+    async def get(self, sha256):
+        return await self._run(self._get, sha256)
+
+    async def find(self, limit=20, **filters):
+        return await self._run(self._find, limit, filters)
+
+    def _opened(self, db):
+        self.total_bytes = db.execute('SELECT COALESCE(SUM(size), 0) FROM outputs').fetchone()[0]
+
+    def _save(self, data, extension, kind, metadata):
+        sha256 = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        try:
+            db = self._connect()
+            if db.execute('UPDATE outputs SET last_access = ? WHERE sha256 = ?', (now, sha256)).rowcount:
+                db.commit()
+                return sha256
+
+            relative_path = os.path.join(sha256[:2], f"{sha256}.{extension}")
+            path = os.path.join(self.directory, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(path + '.tmp', path)
+
+            seed = metadata.get('seed')
+            db.execute('INSERT INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                sha256, relative_path, len(data), kind,
+                metadata.get('prompt'), metadata.get('negative_prompt'),
+                None if metadata.get('user_id') is None else str(metadata['user_id']),
+                None if seed is None else json.dumps(seed),
+                metadata.get('workflow'), now, now))
+            db.commit()
+            self.total_bytes += len(data)
+            self._evict()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Failed to store output {sha256}: {e}")
+        return sha256
+
+    def _get(self, sha256):
+        db = self._connect()
+        row = db.execute('SELECT path, size FROM outputs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, row['path']), 'rb') as file:
+                data = file.read()
+        except OSError:
+            self._delete(sha256, row['path'], row['size'])
+            self._db.commit()
+            return None
+        db.execute('UPDATE outputs SET last_access = ? WHERE sha256 = ?', (time.time(), sha256))
+        db.commit()
+        return data
+
+    def _find(self, limit, filters):
+        db = self._connect()
+        columns = [column for column in ('kind', 'prompt', 'negative_prompt', 'user_id', 'workflow') if filters.get(column) is not None]
+        where = ' AND '.join(f"{column} = ?" for column in columns) or '1'
+        rows = db.execute(f'SELECT * FROM outputs WHERE {where} ORDER BY created DESC LIMIT ?',
+                          [str(filters[column]) for column in columns] + [limit]).fetchall()
+        return [dict(row, seed=json.loads(row['seed']) if row['seed'] else None) for row in rows]
+
+    def _delete(self, sha256, relative_path, size):
+        try:
+            os.remove(os.path.join(self.directory, relative_path))
+        except FileNotFoundError:
+            pass
+        self._db.execute('DELETE FROM outputs WHERE sha256 = ?', (sha256,))
+        self.total_bytes -= size
+
+    def _evict(self):
+        db = self._db
+        if self.max_age is not None:
+            expired = db.execute('SELECT sha256, path, size FROM outputs WHERE last_access < ?', (time.time() - self.max_age,)).fetchall()
+            for row in expired:
+                self._delete(row['sha256'], row['path'], row['size'])
+        if self.max_bytes is not None:
+            while self.total_bytes > self.max_bytes:
+                row = db.execute('SELECT sha256, path, size FROM outputs ORDER BY last_access LIMIT 1').fetchone()
+                if row is None:
+                    break
+                self._delete(row['sha256'], row['path'], row['size'])
+        db.commit()
@@ -0,0 +1,147 @@
+import asyncio
+from io import BytesIO
+
+import discord
+from PIL import Image
+
+from imagePipeline import run_in_executor
+
+PREVIEW_SIZE = 384
+
+
+def make_preview(data, size=PREVIEW_SIZE):
+    image = Image.open(BytesIO(data))
+    image.thumbnail((size, size))
+    buffered = BytesIO()
+    image.convert('RGB').save(buffered, format='JPEG', quality=80)
+    return buffered.getvalue()
+
+
+class ProgressTracker:
+    # The live state of one job's status message. Backends and the scheduler
+    # call update() as often as they like; the reporter decides when the
+    # message is actually edited.
+    def __init__(self, reporter, interaction, message, view=None):
+        self.reporter = reporter
+        self.interaction = interaction
+        self.message = message
+        # Components shown under the message while the job runs (the Cancel button)
+        self.view = view
+        self.position = None
+        self.step = None
+        self.total = None
+        self.preview = None
+        self.last_edit = 0
+        self.closed = False
+        # The latest edit started by the reporter; each waits for the one before it
+        self.flushing = None
+        self._shown_content = message
+        self._shown_preview = False
+
+    def content(self):
+        if self.position:
+            return f"{self.message} You are #{self.position} in the queue."
+        if self.step is not None and self.total:
+            return f"{self.message} Step {self.step}/{self.total}"
+        return self.message
+
+    def update(self, position=None, step=None, total=None, preview=None):
+        if self.closed:
+            return
+        self.position = position
+        if step is not None:
+            self.step, self.total = step, total
+        if preview is not None:
+            self.preview = preview
+        self.reporter.schedule(self)
+
+    def __call__(self, step=None, total=None, preview=None):
+        # Backends report progress by calling the tracker directly
+        self.update(step=step, total=total, preview=preview)
+
+    async def flush(self):
+        preview, self.preview = self.preview, None
+        content = self.content()
+        kwargs = {}
+        if preview is not None and self.reporter.previews:
+            preview = await run_in_executor(make_preview, preview)
+            kwargs['attachments'] = [discord.File(fp=BytesIO(preview), filename='preview.jpg')]
+            self._shown_preview = True
+        if self.closed:
+            return
+        self._shown_content = content
+        await self.interaction.edit_original_response(content=content, **kwargs)
+
+    async def close(self, content=None):
+        # Stops further edits and puts the message back the way it started,
+        # without a stale queue position, step counter, preview or buttons,
+        # or replaces it with content
+        if self.closed:
+            return
+        self.closed = True
+        self.reporter.discard(self)
+        if self.flushing is not None:
+            # An edit already on its way to Discord must land before the final one
+            await asyncio.wait([self.flushing])
+        content = self.message if content is None else content
+        kwargs = {'attachments': []} if self._shown_preview else {}
+        if self.view is not None:
+            kwargs['view'] = None
+        if self._shown_content == content and not kwargs:
+            return
+        try:
+            await self.interaction.edit_original_response(content=content, **kwargs)
+        except discord.HTTPException as e:
+            print(f"Failed to reset progress message: {e}")
+
+
+class ProgressReporter:
+    # Coalesces status edits from every job into one paced stream: each
+    # message is edited at most once per min_interval with its latest state,
+    # and no more than edits_per_second edits start across all messages.
+    def __init__(self, edits_per_second=4, min_interval=2.0, previews=True):
+        self.edits_per_second = edits_per_second
+        self.min_interval = min_interval
+        self.previews = previews
+        self._dirty = set()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def track(self, interaction, message, view=None):
+        return ProgressTracker(self, interaction, message, view)
+
+    def schedule(self, tracker):
+        self._dirty.add(tracker)
+        self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def discard(self, tracker):
+        self._dirty.discard(tracker)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._dirty:
+                now = loop.time()
+                ready = [tracker for tracker in self._dirty if now - tracker.last_edit >= self.min_interval]
+                if not ready:
+                    next_edit = min(tracker.last_edit for tracker in self._dirty) + self.min_interval
+                    await asyncio.sleep(next_edit - now)
+                    continue
+                tracker = min(ready, key=lambda tracker: tracker.last_edit)
+                self._dirty.discard(tracker)
+                tracker.last_edit = now
+                tracker.flushing = asyncio.create_task(self._flush(tracker, tracker.flushing))
+                await asyncio.sleep(1 / self.edits_per_second)
+
+    async def _flush(self, tracker, previous):
+        # Edits to one message are sent in order, so a slow one can't overwrite a newer one
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await tracker.flush()
+        except discord.HTTPException as e:
+            print(f"Failed to update progress message: {e}")
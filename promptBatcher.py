@@ -0,0 +1,87 @@
+import asyncio
+
+
+class BatchEntry:
+    def __init__(self, workflow, metadata, on_progress):
+        self.workflow = workflow
+        self.metadata = metadata
+        self.on_progress = on_progress
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Batch:
+    def __init__(self):
+        self.entries = []
+        self.task = None
+
+
+class PromptBatcher:
+    # Collects text2img jobs with the same prompt for up to `window` seconds
+    # and queues them as one ComfyUI prompt whose latent batch (the template's
+    # BATCH_SIZE_NODES) is scaled up, so the sampler renders them in a single
+    # pass. Jobs with different prompts are never merged: ComfyUI would run
+    # their sampler chains one after another anyway, and it already keeps the
+    # models loaded between prompts.
+    def __init__(self, run_prompt, window, max_batch):
+        # run_prompt(workflow, websocket_output_nodes, on_progress) returns {node id: [GeneratedImage]}
+        self.run_prompt = run_prompt
+        self.window = window
+        self.max_batch = max_batch
+        self._open = {}
+
+    async def submit(self, template, workflow, group, metadata, on_progress=None):
+        # group identifies the inputs (the prompts) a job can share a batch on
+        key = (template.path, template.version, group)
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = Batch()
+            asyncio.get_running_loop().call_later(self.window, self._close, key, batch, template)
+        entry = BatchEntry(workflow, metadata, on_progress)
+        batch.entries.append(entry)
+        if len(batch.entries) >= self.max_batch:
+            self._close(key, batch, template)
+        try:
+            return await entry.future
+        except asyncio.CancelledError:
+            # The merged prompt only stops once every job in it has gone
+            if batch.task is not None and all(other.future.done() for other in batch.entries):
+                batch.task.cancel()
+            raise
+
+    def _close(self, key, batch, template):
+        if self._open.get(key) is not batch:
+            return
+        del self._open[key]
+        batch.task = asyncio.create_task(self._run(batch.entries, template))
+
+    async def _run(self, batch, template):
+        entries = [entry for entry in batch if not entry.future.done()]
+        if not entries:
+            return
+
+        workflow = entries[0].workflow
+        for node in template.batch_size_nodes:
+            workflow[node]['inputs']['batch_size'] *= len(entries)
+
+        def on_progress(**progress):
+            for entry in entries:
+                if entry.on_progress and not entry.future.done():
+                    entry.on_progress(**progress)
+
+        try:
+            outputs = await self.run_prompt(workflow, template.websocket_output_nodes, on_progress)
+        except Exception as e:
+            for entry in entries:
+                if not entry.future.done():
+                    entry.future.set_exception(e)
+            return
+
+        images = [image for node_images in outputs.values() for image in node_images]
+        per_job = len(images) // len(entries)
+        for idx, entry in enumerate(entries):
+            job_images = images[idx * per_job:(idx + 1) * per_job]
+            # Every job in the batch was rendered with the first one's seed
+            for image in job_images:
+                image.metadata = dict(entries[0].metadata)
+            if not entry.future.done():
+                entry.future.set_result(job_images)
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from generatedImage import GeneratedImage
+from imageCache import ImageCache
+from metrics import CACHE_LOOKUPS
+from outputStore import OutputStore
+from sqliteStore import SqliteStore
+
+
+def make_key(*parts):
+    # parts must be JSON serialisable; images should be given by content hash
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def copy_images(images, keep_ref=True):
+    # Callers decode and annotate what they get back, so each gets its own
+    # objects and nothing they do pins memory in the cache
+    return [GeneratedImage(image.data, ref=image.ref if keep_ref else None, metadata=dict(image.metadata)) for image in images]
+
+
+class SharedRun:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class ResultCache(SqliteStore):
+    # Results of deterministic jobs, keyed by everything that determines them.
+    # Recent results are kept in memory under a byte budget; all of them are
+    # written to disk, where OutputStore enforces a size and age budget.
+    # Concurrent requests for the same key share a single run.
+    database = 'results.db'
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            images TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL)''',
+        'CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)',
+    )
+    thread_name = 'result-cache'
+
+    def __init__(self, directory, memory_bytes, max_bytes=None, max_age=None):
+        super().__init__(directory)
+        self.max_age = max_age
+        self.memory = ImageCache(memory_bytes)
+        self._in_flight = {}
+        self.blobs = OutputStore(os.path.join(directory, 'images'), max_bytes=max_bytes, max_age=max_age)
+
+    async def run(self, key, func):
+        # Returns the images func() would return, running it only if no
+        # cached or in-flight result exists for key
+        shared = self._in_flight.get(key)
+        if shared is None:
+            images = await self.get(key)
+            if images is not None:
+                return images
+            shared = self._in_flight.get(key)
+        if shared is None:
+            CACHE_LOOKUPS.inc(result='miss')
+            shared = self._in_flight[key] = SharedRun(asyncio.ensure_future(self._render(key, func)))
+        else:
+            CACHE_LOOKUPS.inc(result='shared')
+
+        shared.waiters += 1
+        try:
+            return copy_images(await asyncio.shield(shared.task))
+        except asyncio.CancelledError:
+            # Only stop the shared run once nobody is waiting for it any more
+            if shared.waiters == 1 and not shared.task.done():
+                shared.task.cancel()
+            raise
+        finally:
+            shared.waiters -= 1
+
+    async def _render(self, key, func):
+        try:
+            images = await func()
+            self.put(key, images)
+            return images
+        finally:
+            del self._in_flight[key]
+
+    async def get(self, key):
+        images = self.memory.get(key)
+        if images is not None:
+            CACHE_LOOKUPS.inc(result='memory')
+            return copy_images(images)
+
+        entries = await self._run(self._get, key)
+        if entries is None:
+            return None
+        images = []
+        for entry in entries:
+            data = await self.blobs.get(entry['sha256'])
+            if data is None:
+                # Part of the result was evicted from disk, which makes all of it useless
+                await self._run(self._delete, key)
+                return None
+            images.append(GeneratedImage(data, metadata=entry['metadata']))
+        CACHE_LOOKUPS.inc(result='disk')
+        self.memory.put(key, images)
+        return copy_images(images)
+
+    def put(self, key, images):
+        images = copy_images(images)
+        self.memory.put(key, images)
+        for image in images:
+            self.blobs.save(image.data, image.extension, 'cache')
+        # Files on a ComfyUI server may be cleaned up, so only the content is kept on disk
+        entries = json.dumps([{'sha256': image.sha256, 'metadata': image.metadata} for image in images])
+        self._run(self._put, key, entries)
+
+    def _get(self, key):
+        try:
+            db = self._connect()
+            row = db.execute('SELECT images FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to read cached result {key}: {e}")
+            return None
+        return json.loads(row[0])
+
+    def _put(self, key, entries):
+        now = time.time()
+        try:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, entries, now, now))
+            if self.max_age is not None:
+                db.execute('DELETE FROM results WHERE last_access < ?', (now - self.max_age,))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to cache result {key}: {e}")
+
+    def _delete(self, key):
+        try:
+            db = self._connect()
+            db.execute('DELETE FROM results WHERE key = ?', (key,))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to drop cached result {key}: {e}")
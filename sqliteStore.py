@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SqliteStore:
+    # A SQLite database in `directory`, opened on first use. One worker thread
+    # owns the connection and does all of the store's disk I/O, in submission
+    # order; subclasses name the file, list their schema and run their
+    # blocking methods through _run.
+    database = None
+    schema = ()
+    thread_name = 'sqlite-store'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.thread_name)
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.directory, self.database))
+            self._db.row_factory = sqlite3.Row
+            for statement in self.schema:
+                self._db.execute(statement)
+            self._db.commit()
+            self._opened(self._db)
+        return self._db
+
+    def _opened(self, db):
+        # Called on the worker thread once the schema is in place
+        pass
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+import aiohttp
+
+from comfyHttp import ComfyHttpClient
+from generatedImage import GeneratedImage, ImageRef
+from imageCache import ImageCache
+from outputStore import OutputStore
+from sqliteStore import SqliteStore
+
+# Refetching an image from ComfyUI is a last resort for a user who is
+# waiting on it, so it fails fast rather than retrying
+REFETCH_TIMEOUT = aiohttp.ClientTimeout(total=15, sock_connect=2)
+
+
+class ViewState:
+    def __init__(self, view_id, prompt, negative_prompt, images):
+        self.view_id = view_id
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        # One dict per image: content hash, ComfyUI file reference and metadata
+        self.images = images
+
+
+class ViewStore(SqliteStore):
+    # What the buttons under a result need, kept out of the views themselves:
+    # the prompt and compact references to each image live in SQLite, so
+    # clicks still work after the view's timeout and after a restart. Image
+    # bytes are served from a byte-budgeted memory cache, then from a
+    # content-addressed spill directory, then from the ComfyUI server that
+    # made them.
+    database = 'views.db'
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS views (
+            view_id TEXT PRIMARY KEY,
+            prompt TEXT,
+            negative_prompt TEXT,
+            images TEXT NOT NULL,
+            created REAL NOT NULL)''',
+        'CREATE INDEX IF NOT EXISTS views_created ON views (created)',
+    )
+    thread_name = 'view-store'
+
+    def __init__(self, directory, cache_bytes, max_bytes=None, max_age=None):
+        super().__init__(directory)
+        self.max_age = max_age
+        # Images by content hash, one per entry
+        self.cache = ImageCache(cache_bytes)
+        self.spill = OutputStore(os.path.join(directory, 'images'), max_bytes=max_bytes, max_age=max_age)
+
+    async def save(self, prompt, negative_prompt, images):
+        # Returns the id to put in the buttons' custom_ids
+        view_id = uuid.uuid4().hex[:16]
+        entries = []
+        for image in images:
+            # A fresh GeneratedImage so the decoded pixels of the original aren't kept alive
+            self.cache.put(image.sha256, [GeneratedImage(image.data, ref=image.ref, metadata=image.metadata)])
+            self.spill.save(image.data, image.extension, 'view')
+            ref = image.ref
+            entries.append({
+                'sha256': image.sha256,
+                'ref': None if ref is None else [ref.server_address, ref.filename, ref.subfolder, ref.folder_type],
+                'metadata': image.metadata,
+            })
+        await self._run(self._save, view_id, prompt, negative_prompt, json.dumps(entries))
+        return view_id
+
+    async def load(self, view_id):
+        return await self._run(self._load, view_id)
+
+    async def image(self, entry):
+        # Returns the GeneratedImage for one of a ViewState's images, or None if it is gone everywhere
+        cached = self.cache.get(entry['sha256'])
+        if cached is not None:
+            return cached[0]
+
+        ref = None if entry['ref'] is None else ImageRef(*entry['ref'])
+        data = await self.spill.get(entry['sha256'])
+        if data is None and ref is not None:
+            try:
+                data = await ComfyHttpClient(ref.server_address).get_image(ref.filename, ref.subfolder, ref.folder_type,
+                                                                            retries=0, timeout=REFETCH_TIMEOUT)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Failed to fetch {ref.filename} from {ref.server_address}: {e!r}")
+        if data is None:
+            return None
+
+        image = GeneratedImage(data, ref=ref, metadata=entry['metadata'])
+        self.cache.put(image.sha256, [image])
+        return image
+
+    def _save(self, view_id, prompt, negative_prompt, images):
+        now = time.time()
+        try:
+            db = self._connect()
+            db.execute('INSERT INTO views VALUES (?, ?, ?, ?, ?)', (view_id, prompt, negative_prompt, images, now))
+            if self.max_age is not None:
+                db.execute('DELETE FROM views WHERE created < ?', (now - self.max_age,))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to store view {view_id}: {e}")
+
+    def _load(self, view_id):
+        row = self._connect().execute('SELECT prompt, negative_prompt, images FROM views WHERE view_id = ?', (view_id,)).fetchone()
+        if row is None:
+            return None
+        return ViewState(view_id, row[0], row[1], json.loads(row[2]))
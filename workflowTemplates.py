@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import random
+import time
+
+# How often (in seconds) a template checks its file for changes. Checks are a
+# single stat() and happen lazily when a job asks for the template.
+RELOAD_CHECK_INTERVAL = 2
+
+# config key -> (workflow input patched on each listed node, job value it takes)
+NODE_PATCHES = {
+    'PROMPT_NODES': ('text', 'prompt'),
+    'NEG_PROMPT_NODES': ('text', 'negative_prompt'),
+    'RAND_SEED_NODES': ('seed', 'seed'),
+    'FILE_INPUT_NODES': ('image', 'image'),
+}
+
+# config key -> input the listed nodes must have (None if any node will do).
+# SaveImageWebsocket nodes stream their images back as binary websocket frames
+# instead of being fetched through /history and /view; batch size nodes
+# (EmptyLatentImage) are scaled up when identical prompts are batched together.
+NODE_ROLES = {
+    'WEBSOCKET_OUTPUT_NODES': None,
+    'BATCH_SIZE_NODES': 'batch_size',
+}
+
+
+def parse_node_list(value):
+    return [node.strip() for node in value.split(',') if node.strip()]
+
+
+class WorkflowTemplate:
+    def __init__(self, path, node_lists):
+        self.path = path
+        self.node_lists = node_lists
+        self.version = 0
+        self._serialized = None
+        self._patch_plan = []
+        self._mtime = None
+        self._checked_at = time.monotonic()
+        self.load()
+
+    @classmethod
+    def from_config(cls, section):
+        node_lists = {key: parse_node_list(section.get(key, '')) for key in list(NODE_PATCHES) + list(NODE_ROLES)}
+        return cls(section['CONFIG'], node_lists)
+
+    @property
+    def websocket_output_nodes(self):
+        return self.node_lists.get('WEBSOCKET_OUTPUT_NODES', [])
+
+    @property
+    def batch_size_nodes(self):
+        return self.node_lists.get('BATCH_SIZE_NODES', [])
+
+    @property
+    def deterministic(self):
+        # Without randomised seeds the same inputs always render the same images
+        return not self.node_lists.get('RAND_SEED_NODES')
+
+    def cache_key(self, prompt=None, negative_prompt=None, image=None):
+        # Identifies what build() with these values would render: the workflow
+        # as loaded plus the values actually patched into it. image should be
+        # the input's content hash, since its filename depends on the server.
+        self.refresh()
+        values = {'prompt': prompt, 'negative_prompt': negative_prompt, 'image': image}
+        patched = sorted({field for node, input_name, field in self._patch_plan if field != 'seed'})
+        key = json.dumps([self._serialized, [(field, values[field]) for field in patched]])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'r') as file:
+            workflow = json.load(file)
+
+        required_inputs = {key: input_name for key, (input_name, field) in NODE_PATCHES.items()}
+        required_inputs.update(NODE_ROLES)
+        for key, input_name in required_inputs.items():
+            for node in self.node_lists.get(key, []):
+                if node not in workflow:
+                    raise ValueError(f"{self.path}: node '{node}' listed in {key} does not exist in the workflow")
+                if input_name is not None and input_name not in workflow[node].get('inputs', {}):
+                    raise ValueError(f"{self.path}: node '{node}' listed in {key} has no '{input_name}' input")
+
+        patch_plan = []
+        for key, (input_name, field) in NODE_PATCHES.items():
+            for node in self.node_lists.get(key, []):
+                patch_plan.append((node, input_name, field))
+
+        self._serialized = json.dumps(workflow)
+        self._patch_plan = patch_plan
+        self._mtime = mtime
+        self.version += 1
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            self.load()
+            print(f"Reloaded workflow {self.path}")
+        except (OSError, ValueError) as e:
+            # Keep serving the last good version until the file is fixed
+            self._mtime = mtime
+            print(f"Failed to reload workflow {self.path}, keeping the previous version: {e}")
+
+    def build(self, prompt=None, negative_prompt=None, image=None):
+        self.refresh()
+        values = {'prompt': prompt, 'negative_prompt': negative_prompt, 'image': image}
+        workflow = json.loads(self._serialized)
+        for node, input_name, field in self._patch_plan:
+            if field == 'seed':
+                workflow[node]['inputs'][input_name] = random.randint(0, 999999999999999)
+            elif values[field] is not None:
+                workflow[node]['inputs'][input_name] = values[field]
+        return workflow
+
+    def seed(self, workflow):
+        # The seed the first seeded node of a built workflow was given, for the record
+        for node, input_name, field in self._patch_plan:
+            if field == 'seed':
+                return workflow[node]['inputs'][input_name]
+        return None
+
+
+class TemplateRegistry:
+    def __init__(self):
+        self.templates = {}
+
+    def register(self, name, section):
+        self.templates[name] = WorkflowTemplate.from_config(section)
+        return self.templates[name]
+
+    def get(self, name):
+        return self.templates[name]